@@ -0,0 +1,5 @@
+# Celery-приложение загружается вместе с Django, чтобы shared_task-задачи
+# из views ставились в очередь с брокером из настроек
+from .celery import app as celery_app
+
+__all__ = ('celery_app',)
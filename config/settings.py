@@ -185,7 +185,13 @@ MEDIA_ROOT = BASE_DIR / 'media'
 
 # Максимальный размер загружаемого файла (50 MB)
 DATA_UPLOAD_MAX_MEMORY_SIZE = 52428800
-FILE_UPLOAD_MAX_MEMORY_SIZE = 52428800
+
+# Файлы крупнее порога пишутся во временный файл по мере приема; SHA-256 считается на лету
+FILE_UPLOAD_MAX_MEMORY_SIZE = 2621440
+FILE_UPLOAD_HANDLERS = [
+    'core.uploads.HashingMemoryFileUploadHandler',
+    'core.uploads.HashingTemporaryFileUploadHandler',
+]
 
 # ============================================
 # НАСТРОЙКИ RAG СИСТЕМЫ
@@ -194,6 +200,20 @@ FILE_UPLOAD_MAX_MEMORY_SIZE = 52428800
 # OpenAI API
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 
+# HTTP-клиент OpenAI: один пул keep-alive соединений на процесс (services/openai_client.py)
+OPENAI_MAX_CONNECTIONS = int(os.getenv('OPENAI_MAX_CONNECTIONS', 100))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('OPENAI_MAX_KEEPALIVE_CONNECTIONS', 20))
+OPENAI_KEEPALIVE_EXPIRY = 60  # секунд простоя до закрытия соединения
+OPENAI_HTTP2 = True  # используется, если установлен пакет h2
+OPENAI_CONNECT_TIMEOUT = 5.0
+OPENAI_MAX_RETRIES = 2  # повторы SDK (429/5xx/обрывы) с экспоненциальной паузой
+# Таймаут ответа (секунд) по типу вызова
+OPENAI_TIMEOUTS = {
+    'default': 60.0,
+    'embeddings': 30.0,
+    'chat': 90.0,
+}
+
 # Параметры чанкинга
 RAG_CHUNK_SIZE = 1200  # символов
 RAG_CHUNK_OVERLAP = 200  # символов
@@ -201,8 +221,66 @@ RAG_CHUNK_OVERLAP = 200  # символов
 # Параметры поиска
 RAG_TOP_K = 5  # количество релевантных чанков
 
+# Бэкенд векторного поиска:
+#   'pgvector' — сортировка по косинусному расстоянию в Postgres через ANN-индекс (HNSW)
+#   'exact'    — точный перебор всех векторов бота в Python
+RAG_SEARCH_BACKEND = os.getenv('RAG_SEARCH_BACKEND', 'pgvector')
+# Итеративный обход HNSW (pgvector >= 0.8): индекс продолжает поиск, пока фильтр по боту
+# не наберет top_k. '' — выключено; недобор тогда досчитывается точным запросом в Postgres
+RAG_HNSW_ITERATIVE_SCAN = os.getenv('RAG_HNSW_ITERATIVE_SCAN', '')  # 'strict_order' / 'relaxed_order'
+
+# Гибридный поиск (BotAgent.rag_search_mode = 'hybrid' / 'fusion')
+RAG_HYBRID_CANDIDATES = 200  # кандидатов из полнотекстового индекса
+
+# Сборка контекста для ответа: бюджет (оценочных) токенов и минимальная похожесть фрагмента
+RAG_CONTEXT_TOKEN_BUDGET = 2000
+RAG_CONTEXT_MIN_SIMILARITY = 0.3
+
+# Кэш матриц векторов для точного поиска (в памяти процесса, LRU по ботам)
+RAG_MATRIX_CACHE_MAX_BYTES = int(os.getenv('RAG_MATRIX_CACHE_MAX_BYTES', 256 * 1024 * 1024))  # 256 MB
+RAG_MATRIX_CACHE_TTL = 300  # секунд; страховка для изменений из других процессов
+
 # Модели OpenAI
 RAG_EMBEDDING_MODEL = 'text-embedding-3-small'  # для векторизации
+RAG_EMBEDDING_DIMENSIONS = int(os.getenv('RAG_EMBEDDING_DIMENSIONS', 1536))  # text-embedding-3 умеет укорачивать векторы
+
+# Формат хранения KnowledgeChunk.embedding (переводится командой rag_convert_embeddings):
+#   'vector'  — float32
+#   'halfvec' — float16: таблица и индекс вдвое меньше (pgvector >= 0.7)
+#   'bit'     — полные float32-векторы + бинарный HNSW-индекс, кандидаты переранжируются по полным векторам
+RAG_EMBEDDING_STORAGE = os.getenv('RAG_EMBEDDING_STORAGE', 'vector')
+RAG_BINARY_RERANK_FACTOR = 4  # 'bit': кандидатов на переранжирование = top_k * factor
+# Метрика поиска в pgvector: 'cosine' или 'ip' (скалярное произведение по нормированным векторам).
+# 'ip' включать после `manage.py rag_normalize_embeddings --rebuild-index`
+RAG_VECTOR_METRIC = os.getenv('RAG_VECTOR_METRIC', 'cosine')
+
+# Пакетная векторизация документов
+RAG_EMBEDDING_BATCH_SIZE = 256  # текстов в одном запросе (лимит API — 2048)
+RAG_EMBEDDING_BATCH_TOKENS = 200000  # оценка токенов на запрос (лимит API — 300k)
+RAG_EMBEDDING_CONCURRENCY = 4  # одновременных запросов
+RAG_EMBEDDING_MAX_RETRIES = 3  # повторов для упавших батчей
+
+# Запись чанков в БД
+RAG_BULK_CREATE_BATCH_SIZE = 1000  # строк в одном INSERT/COPY
+RAG_COPY_THRESHOLD = 5000  # с этого количества чанков пишем через COPY
+RAG_INDEX_FLUSH_SIZE = 1024  # чанков, накапливаемых перед записью (и контрольной точкой)
+RAG_SHARED_EMBEDDINGS = True  # переиспользовать векторы одинаковых фрагментов между документами
+RAG_INDEX_PROGRESS_TIMEOUT = 24 * 3600  # хранение прогресса индексации в Redis
+RAG_FANOUT_RANGE_SIZE = 2000  # чанков на одну задачу векторизации в распределенной индексации
+RAG_INDEX_RESUME = True  # продолжать прерванную индексацию того же файла с контрольной точки
+
+# Параллельное извлечение текста из PDF (1 — последовательно).
+# Дочерние процессы prefork-пула Celery не могут создавать свои процессы, поэтому
+# при RAG_PDF_WORKERS > 1 воркер индексации запускается с --pool threads или --pool solo:
+#   celery -A config worker --pool threads --concurrency 2
+RAG_PDF_WORKERS = int(os.getenv('RAG_PDF_WORKERS', 1))  # процессов в пуле
+RAG_PDF_PAGES_PER_TASK = int(os.getenv('RAG_PDF_PAGES_PER_TASK', 20))  # страниц в одной задаче
+
+# Кэш извлеченного из PDF/DOCX текста (zlib) по хешу файла; пустая строка отключает.
+# Лежит рядом с MEDIA_ROOT, но не внутри него: MEDIA_URL раздает файлы публично
+RAG_TEXT_CACHE_DIR = os.getenv('RAG_TEXT_CACHE_DIR', str(MEDIA_ROOT.parent / 'media_text_cache'))
+RAG_TEXT_CACHE_MAX_BYTES = int(os.getenv('RAG_TEXT_CACHE_MAX_BYTES', 2 * 1024 ** 3))  # 2 GB
+RAG_TEXT_CACHE_MAX_AGE = 30 * 24 * 3600  # записи без использования дольше 30 дней удаляются
 RAG_GENERATION_MODEL = 'gpt-4o-mini'  # для генерации ответов
 RAG_GENERATION_TEMPERATURE = 0.3  # низкая температура для точности
 
@@ -219,6 +297,14 @@ CELERY_TIMEZONE = TIME_ZONE
 CELERY_TASK_TRACK_STARTED = True
 CELERY_TASK_TIME_LIMIT = 30 * 60  # 30 минут
 
+# Периодические задачи (django_celery_beat заносит их в расписание в БД)
+CELERY_BEAT_SCHEDULE = {
+    'prune-text-cache': {
+        'task': 'core.tasks.prune_text_cache',
+        'schedule': 24 * 3600,
+    },
+}
+
 # ============================================
 # КЭШИРОВАНИЕ (Redis)
 # ============================================
@@ -245,6 +331,19 @@ CACHES = {
 # Кэш для RAG ответов
 RAG_CACHE_TIMEOUT = 3600  # 1 час
 
+# Кэш эмбеддингов запросов: LRU в процессе + общий Redis
+RAG_QUERY_EMBEDDING_CACHE_SIZE = 10000  # записей в памяти процесса
+RAG_QUERY_EMBEDDING_CACHE_TIMEOUT = 7 * 24 * 3600  # 7 дней в Redis
+
+# Кэш результатов поиска (id и похожесть top-k) на RAG_CACHE_TIMEOUT;
+# сбрасывается версией знаний бота при переиндексации и смене документов
+RAG_RETRIEVAL_CACHE = True
+
+# Семантический кэш ответов (включается в настройках бота); время жизни — RAG_CACHE_TIMEOUT
+RAG_ANSWER_CACHE_MAX_ENTRIES = 100  # последних ответов на бота
+RAG_ANSWER_CACHE_MIN_QUERY_LENGTH = 10  # короткие реплики ("да", "ок") не кэшируем
+RAG_ANSWER_CACHE_MAX_HISTORY = 0  # кэшировать только вопросы без истории диалога
+
 # ============================================
 # ЛОГИРОВАНИЕ
 # ============================================
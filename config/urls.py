@@ -98,7 +98,10 @@ urlpatterns = [
     
     # API действия с RAG
     path('api/knowledge/<int:kb_id>/reindex/', views.reindex_knowledge_base, name='reindex_kb'),
+    path('api/knowledge/<int:kb_id>/status/', views.knowledge_index_status, name='knowledge_index_status'),
     path('api/bot/<int:bot_id>/rag/test/', views.test_rag_search, name='test_rag'),
+    path('api/bot/<int:bot_id>/rag/answer-cache-stats/', views.bot_answer_cache_stats, name='bot_answer_cache_stats'),
+    path('api/rag/cache-stats/', views.rag_cache_stats, name='rag_cache_stats'),
 
     # ============================================
     # CRM INTEGRATIONS
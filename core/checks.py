@@ -0,0 +1,62 @@
+# core/checks.py
+"""
+Системные проверки: схема векторов в БД должна совпадать с настройками RAG.
+Формат и размерность KnowledgeChunk.embedding меняет команда rag_convert_embeddings
+в обход миграций, поэтому расхождение ловится при запуске, а не на первой вставке.
+"""
+
+from django.conf import settings
+from django.core.checks import Error, Warning, register
+
+
+@register()
+def rag_embedding_schema_check(app_configs, **kwargs):
+    from django.db import DatabaseError, connection
+    from core.management.commands.rag_convert_embeddings import INDEX_NAME
+    from core.models import KnowledgeChunk
+    
+    if connection.vendor != 'postgresql':
+        return []
+    
+    table = KnowledgeChunk._meta.db_table
+    storage = getattr(settings, 'RAG_EMBEDDING_STORAGE', 'vector')
+    dimensions = getattr(settings, 'RAG_EMBEDDING_DIMENSIONS', 1536)
+    metric = getattr(settings, 'RAG_VECTOR_METRIC', 'cosine')
+    
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT format_type(atttypid, atttypmod) FROM pg_attribute "
+                "WHERE attrelid = to_regclass(%s) AND attname = 'embedding'",
+                [table]
+            )
+            column = cursor.fetchone()
+            cursor.execute("SELECT indexdef FROM pg_indexes WHERE indexname = %s", [INDEX_NAME])
+            index = cursor.fetchone()
+    except DatabaseError:
+        # БД недоступна (сборка образа, collectstatic) — сверять не с чем
+        return []
+    
+    if not column:
+        # Таблицы еще нет: migrate создаст ее, проверка сработает при следующем запуске
+        return []
+    
+    errors = []
+    expected_type = f"{'halfvec' if storage == 'halfvec' else 'vector'}({dimensions})"
+    if column[0] != expected_type:
+        errors.append(Error(
+            f'{table}.embedding в БД имеет тип {column[0]}, а настройки RAG ожидают {expected_type}',
+            hint='Выполните manage.py rag_convert_embeddings или исправьте '
+                 'RAG_EMBEDDING_STORAGE / RAG_EMBEDDING_DIMENSIONS',
+            id='core.E001',
+        ))
+    
+    opclass = 'bit_hamming_ops' if storage == 'bit' else f'{storage}_{metric}_ops'
+    if not index or opclass not in index[0]:
+        errors.append(Warning(
+            f'Индекс {INDEX_NAME} не построен с {opclass}: поиск пойдет полным перебором',
+            hint='Выполните manage.py rag_convert_embeddings (для метрики ip — rag_normalize_embeddings --rebuild-index)',
+            id='core.W001',
+        ))
+    
+    return errors
@@ -0,0 +1,114 @@
+# core/management/commands/rag_convert_embeddings.py
+"""
+Перевод хранения векторов KnowledgeChunk.embedding на месте:
+укорачивание размерности и/или смена формата (vector / halfvec / bit-индекс).
+
+Пример:
+    python manage.py rag_convert_embeddings --storage halfvec --dimensions 512
+"""
+
+import re
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from core.models import KnowledgeChunk
+
+INDEX_NAME = 'knowledge_chunks_embedding_hnsw'
+STORAGE_CHOICES = ['vector', 'halfvec', 'bit']
+METRIC_CHOICES = ['cosine', 'ip']
+
+
+def vector_index_sql(storage: str, dimensions: int, metric: str = 'cosine') -> str:
+    """DDL HNSW-индекса по embedding для выбранного формата хранения и метрики"""
+    table = KnowledgeChunk._meta.db_table
+    if storage == 'bit':
+        return (
+            f"CREATE INDEX {INDEX_NAME} ON {table} USING hnsw "
+            f"((binary_quantize(embedding)::bit({dimensions})) bit_hamming_ops) "
+            f"WITH (m = 16, ef_construction = 64)"
+        )
+    return (
+        f"CREATE INDEX {INDEX_NAME} ON {table} USING hnsw "
+        f"(embedding {storage}_{metric}_ops) WITH (m = 16, ef_construction = 64)"
+    )
+
+
+def current_column_type(table: str):
+    """Тип и размерность колонки embedding в БД, например ('vector', 1536)"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT format_type(atttypid, atttypmod) FROM pg_attribute "
+            "WHERE attrelid = %s::regclass AND attname = 'embedding'",
+            [table]
+        )
+        row = cursor.fetchone()
+
+    match = re.fullmatch(r'(\w+)\((\d+)\)', row[0] if row else '')
+    if not match:
+        raise CommandError(f'Неожиданный тип колонки embedding: {row}')
+    return match.group(1), int(match.group(2))
+
+
+class Command(BaseCommand):
+    help = 'Переводит векторы фрагментов в формат и размерность из настроек (на месте, с пересозданием индекса)'
+    # Команда как раз исправляет схему, о которой сообщают core.E001 / core.W001
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--storage',
+            choices=STORAGE_CHOICES,
+            default=getattr(settings, 'RAG_EMBEDDING_STORAGE', 'vector'),
+        )
+        parser.add_argument(
+            '--dimensions',
+            type=int,
+            default=getattr(settings, 'RAG_EMBEDDING_DIMENSIONS', 1536),
+        )
+
+    def handle(self, *args, **options):
+        storage = options['storage']
+        dimensions = options['dimensions']
+        table = KnowledgeChunk._meta.db_table
+
+        current_type, current_dimensions = current_column_type(table)
+        if dimensions > current_dimensions:
+            raise CommandError(
+                f'Нельзя увеличить размерность {current_dimensions} -> {dimensions}: '
+                f'нужна полная переиндексация документов'
+            )
+
+        # bit хранит полные float32-векторы для переранжирования; меняется только индекс
+        column_type = 'halfvec' if storage == 'halfvec' else 'vector'
+
+        self.stdout.write(
+            f'{table}.embedding: {current_type}({current_dimensions}) -> {column_type}({dimensions}), '
+            f'индекс: {storage}'
+        )
+
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(f"DROP INDEX IF EXISTS {INDEX_NAME}")
+
+                if (column_type, dimensions) != (current_type, current_dimensions):
+                    using = 'embedding::vector'
+                    if dimensions < current_dimensions:
+                        # Укороченный вектор text-embedding-3 = первые N координат после нормировки
+                        using = f'l2_normalize(subvector({using}, 1, {dimensions}))'
+                    cursor.execute(
+                        f"ALTER TABLE {table} ALTER COLUMN embedding "
+                        f"TYPE {column_type}({dimensions}) USING ({using})::{column_type}({dimensions})"
+                    )
+                    if dimensions < current_dimensions:
+                        cursor.execute(f"UPDATE {table} SET is_normalized = true WHERE NOT is_normalized")
+
+                cursor.execute(vector_index_sql(
+                    storage, dimensions, getattr(settings, 'RAG_VECTOR_METRIC', 'cosine')
+                ))
+
+        self.stdout.write(self.style.SUCCESS(
+            'Готово. Проверьте, что RAG_EMBEDDING_STORAGE и RAG_EMBEDDING_DIMENSIONS '
+            'совпадают с выбранными значениями, и перезапустите воркеры.'
+        ))
@@ -0,0 +1,78 @@
+# core/management/commands/rag_normalize_embeddings.py
+"""
+Разовая нормировка векторов, записанных до появления флага is_normalized.
+После нее поиск может считать близость скалярным произведением (RAG_VECTOR_METRIC = 'ip').
+
+Пример:
+    python manage.py rag_normalize_embeddings --rebuild-index --metric ip
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from core.models import BotAgent, KnowledgeChunk
+from core.management.commands.rag_convert_embeddings import (
+    INDEX_NAME, METRIC_CHOICES, current_column_type, vector_index_sql,
+)
+
+
+class Command(BaseCommand):
+    help = 'Нормирует векторы фрагментов до единичной длины и (опционально) пересоздает индекс под метрику'
+    # Команда как раз исправляет схему, о которой сообщают core.E001 / core.W001
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument(
+            '--rebuild-index',
+            action='store_true',
+            help='Пересоздать HNSW-индекс под метрику --metric',
+        )
+        parser.add_argument(
+            '--metric',
+            choices=METRIC_CHOICES,
+            default=getattr(settings, 'RAG_VECTOR_METRIC', 'cosine'),
+        )
+
+    def handle(self, *args, **options):
+        table = KnowledgeChunk._meta.db_table
+        batch_size = options['batch_size']
+
+        # Пачками в отдельных транзакциях: блокировки короткие, прогресс не теряется
+        total = 0
+        while True:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"""
+                    UPDATE {table} SET embedding = l2_normalize(embedding), is_normalized = true
+                    WHERE id IN (
+                        SELECT id FROM {table} WHERE NOT is_normalized ORDER BY id LIMIT %s
+                    )
+                    """,
+                    [batch_size]
+                )
+                updated = cursor.rowcount
+            if not updated:
+                break
+            total += updated
+            self.stdout.write(f'Нормировано: {total}')
+
+        if options['rebuild_index']:
+            storage = getattr(settings, 'RAG_EMBEDDING_STORAGE', 'vector')
+            _, dimensions = current_column_type(table)
+            self.stdout.write(f'Пересоздание индекса {INDEX_NAME} ({storage}, {options["metric"]})')
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute(f"DROP INDEX IF EXISTS {INDEX_NAME}")
+                    cursor.execute(vector_index_sql(storage, dimensions, options['metric']))
+
+        # Сырой SQL не вызывает сигналы — сбрасываем кэши поиска всех ботов сами
+        from services.rag_service import invalidate_bot_knowledge
+        invalidate_bot_knowledge(bot_ids=BotAgent.objects.values_list('id', flat=True))
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Готово, нормировано {total} векторов. Для поиска по скалярному произведению '
+            f'установите RAG_VECTOR_METRIC=ip (индекс должен быть пересоздан с --metric ip) '
+            f'и перезапустите воркеры.'
+        ))
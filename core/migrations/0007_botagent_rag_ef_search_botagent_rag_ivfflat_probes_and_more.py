@@ -0,0 +1,28 @@
+# Generated by Django 4.2.9 on 2026-10-16 10:12
+
+from django.db import migrations, models
+import pgvector.django
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_botagent_notification_recipient'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='botagent',
+            name='rag_ef_search',
+            field=models.IntegerField(default=40, help_text='Размер списка кандидатов HNSW. Больше — точнее, но медленнее', verbose_name='HNSW ef_search'),
+        ),
+        migrations.AddField(
+            model_name='botagent',
+            name='rag_ivfflat_probes',
+            field=models.IntegerField(default=10, help_text='Количество просматриваемых списков IVFFlat (если используется IVFFlat-индекс)', verbose_name='IVFFlat probes'),
+        ),
+        migrations.AddIndex(
+            model_name='knowledgechunk',
+            index=pgvector.django.HnswIndex(ef_construction=64, fields=['embedding'], m=16, name='knowledge_chunks_embedding_hnsw', opclasses=['vector_cosine_ops']),
+        ),
+    ]
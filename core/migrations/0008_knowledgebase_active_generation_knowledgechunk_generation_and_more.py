@@ -0,0 +1,27 @@
+# Generated by Django 4.2.9 on 2026-10-16 11:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_botagent_rag_ef_search_botagent_rag_ivfflat_probes_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='knowledgebase',
+            name='active_generation',
+            field=models.PositiveIntegerField(default=0, help_text='Поиск видит только фрагменты этого поколения; переиндексация пишет новое и атомарно переключает', verbose_name='Активное поколение фрагментов'),
+        ),
+        migrations.AddField(
+            model_name='knowledgechunk',
+            name='generation',
+            field=models.PositiveIntegerField(default=0, verbose_name='Поколение индексации'),
+        ),
+        migrations.AddIndex(
+            model_name='knowledgechunk',
+            index=models.Index(fields=['knowledge_base', 'generation'], name='knowledge_c_knowled_aae90a_idx'),
+        ),
+    ]
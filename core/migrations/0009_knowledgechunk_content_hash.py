@@ -0,0 +1,35 @@
+# Generated by Django 4.2.9 on 2026-10-16 12:25
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def fill_content_hash(apps, schema_editor):
+    KnowledgeChunk = apps.get_model('core', 'KnowledgeChunk')
+    
+    batch = []
+    for chunk in KnowledgeChunk.objects.filter(content_hash='').only('id', 'text').iterator(chunk_size=2000):
+        chunk.content_hash = hashlib.sha256(chunk.text.encode('utf-8')).hexdigest()
+        batch.append(chunk)
+        if len(batch) >= 1000:
+            KnowledgeChunk.objects.bulk_update(batch, ['content_hash'])
+            batch = []
+    if batch:
+        KnowledgeChunk.objects.bulk_update(batch, ['content_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_knowledgebase_active_generation_knowledgechunk_generation_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='knowledgechunk',
+            name='content_hash',
+            field=models.CharField(blank=True, help_text='SHA-256 текста фрагмента: неизмененные фрагменты не векторизуются повторно', max_length=64, verbose_name='Хеш текста'),
+        ),
+        migrations.RunPython(fill_content_hash, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.9 on 2026-10-16 13:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_knowledgechunk_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='botagent',
+            name='rag_search_mode',
+            field=models.CharField(choices=[('vector', 'Векторный'), ('hybrid', 'Гибридный: отбор по словам + векторы'), ('fusion', 'Гибридный: слияние рангов слов и векторов')], default='vector', max_length=20, verbose_name='Режим поиска по базе знаний'),
+        ),
+        # Генерируемая колонка не описана в модели: Postgres заполняет ее сам,
+        # а ORM и COPY перечисляют колонки явно и ее не трогают.
+        migrations.RunSQL(
+            sql="""
+                ALTER TABLE knowledge_chunks
+                    ADD COLUMN search_vector tsvector
+                    GENERATED ALWAYS AS (to_tsvector('simple', text)) STORED;
+                CREATE INDEX knowledge_chunks_search_vector_gin
+                    ON knowledge_chunks USING gin (search_vector);
+            """,
+            reverse_sql="""
+                DROP INDEX IF EXISTS knowledge_chunks_search_vector_gin;
+                ALTER TABLE knowledge_chunks DROP COLUMN IF EXISTS search_vector;
+            """,
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.9 on 2026-10-16 15:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_botagent_rag_search_mode_knowledgechunk_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='botagent',
+            name='answer_cache_enabled',
+            field=models.BooleanField(default=False, verbose_name='Кэшировать ответы на похожие вопросы'),
+        ),
+        migrations.AddField(
+            model_name='botagent',
+            name='answer_cache_threshold',
+            field=models.FloatField(default=0.95, help_text='Косинусная похожесть вопросов (0-1), при которой возвращается сохраненный ответ', verbose_name='Порог похожести для кэша ответов'),
+        ),
+    ]
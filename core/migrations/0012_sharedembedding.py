@@ -0,0 +1,31 @@
+# Generated by Django 4.2.9 on 2026-10-16 15:40
+
+from django.db import migrations, models
+import pgvector.django
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_botagent_answer_cache_enabled_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SharedEmbedding',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=100, verbose_name='Модель эмбеддингов')),
+                ('dimensions', models.PositiveIntegerField(verbose_name='Размерность')),
+                ('text_hash', models.CharField(max_length=64, verbose_name='SHA-256 текста')),
+                ('embedding', pgvector.django.VectorField(verbose_name='Вектор')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Создан')),
+            ],
+            options={
+                'verbose_name': 'Общий вектор',
+                'verbose_name_plural': 'Общие векторы',
+                'db_table': 'shared_embeddings',
+                'unique_together': {('model', 'dimensions', 'text_hash')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.9 on 2026-10-16 16:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_sharedembedding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='knowledgechunk',
+            name='is_normalized',
+            field=models.BooleanField(default=False, help_text='Вектор единичной длины: косинусная близость равна скалярному произведению', verbose_name='Вектор нормирован'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.9 on 2026-10-16 18:02
+
+from django.db import migrations
+import pgvector.django
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_knowledgechunk_is_normalized'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='knowledgechunk',
+            name='embedding',
+            field=pgvector.django.VectorField(dimensions=1536, help_text='Пусто, пока фрагмент ждет векторизации в распределенной индексации', null=True, verbose_name='Вектор'),
+        ),
+    ]
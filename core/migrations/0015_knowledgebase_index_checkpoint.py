@@ -0,0 +1,28 @@
+# Generated by Django 4.2.9 on 2026-10-16 18:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_alter_knowledgechunk_embedding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='knowledgebase',
+            name='file_hash',
+            field=models.CharField(blank=True, db_index=True, help_text='SHA-256 содержимого файла на момент последней индексации', max_length=64, verbose_name='Хеш файла'),
+        ),
+        migrations.AddField(
+            model_name='knowledgebase',
+            name='index_generation',
+            field=models.PositiveIntegerField(blank=True, help_text='Поколение, которое строит незавершенная индексация; повторный запуск продолжает его', null=True, verbose_name='Недописанное поколение'),
+        ),
+        migrations.AddField(
+            model_name='knowledgebase',
+            name='index_checkpoint',
+            field=models.IntegerField(default=-1, help_text='Последний chunk_index, записанный в недописанное поколение', verbose_name='Контрольная точка индексации'),
+        ),
+    ]
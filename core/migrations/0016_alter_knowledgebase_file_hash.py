@@ -0,0 +1,18 @@
+# Generated by Django 4.2.9 on 2026-10-16 19:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_knowledgebase_index_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='knowledgebase',
+            name='file_hash',
+            field=models.CharField(blank=True, db_index=True, help_text='SHA-256 содержимого файла: дедупликация загрузок и продолжение индексации', max_length=64, verbose_name='Хеш файла'),
+        ),
+    ]
@@ -4,7 +4,7 @@
 from django.db import models
 from django.contrib.auth.models import User
 from django.utils import timezone
-from pgvector.django import VectorField
+from pgvector.django import VectorField, HnswIndex
 import re
 
 # ============================================
@@ -40,6 +40,12 @@ class BotAgent(models.Model):
         ('error', 'Ошибка'),
     ]
     
+    RAG_SEARCH_MODE_CHOICES = [
+        ('vector', 'Векторный'),
+        ('hybrid', 'Гибридный: отбор по словам + векторы'),
+        ('fusion', 'Гибридный: слияние рангов слов и векторов'),
+    ]
+    
     # ========== ПОЛНЫЙ СПИСОК МОДЕЛЕЙ (Legacy + Reasoning + Future) ==========
     MODEL_CHOICES = [
         # ===== GPT-3.5 (Legacy, Дешевые) =====
@@ -159,6 +165,38 @@ class BotAgent(models.Model):
         verbose_name='Количество релевантных фрагментов'
     )
     
+    rag_search_mode = models.CharField(
+        max_length=20,
+        choices=RAG_SEARCH_MODE_CHOICES,
+        default='vector',
+        verbose_name='Режим поиска по базе знаний'
+    )
+    
+    # Семантический кэш ответов
+    answer_cache_enabled = models.BooleanField(
+        default=False,
+        verbose_name='Кэшировать ответы на похожие вопросы'
+    )
+    
+    answer_cache_threshold = models.FloatField(
+        default=0.95,
+        verbose_name='Порог похожести для кэша ответов',
+        help_text='Косинусная похожесть вопросов (0-1), при которой возвращается сохраненный ответ'
+    )
+    
+    # Параметры ANN-поиска pgvector (точность/скорость)
+    rag_ef_search = models.IntegerField(
+        default=40,
+        verbose_name='HNSW ef_search',
+        help_text='Размер списка кандидатов HNSW. Больше — точнее, но медленнее'
+    )
+    
+    rag_ivfflat_probes = models.IntegerField(
+        default=10,
+        verbose_name='IVFFlat probes',
+        help_text='Количество просматриваемых списков IVFFlat (если используется IVFFlat-индекс)'
+    )
+    
     # Метаданные
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Создан')
     updated_at = models.DateTimeField(auto_now=True, verbose_name='Обновлен')
@@ -321,6 +359,31 @@ class KnowledgeBase(models.Model):
     chunks_count = models.IntegerField(default=0, verbose_name='Количество фрагментов')
     indexed_at = models.DateTimeField(null=True, blank=True, verbose_name='Дата индексации')
     
+    active_generation = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Активное поколение фрагментов',
+        help_text='Поиск видит только фрагменты этого поколения; переиндексация пишет новое и атомарно переключает'
+    )
+    
+    file_hash = models.CharField(
+        max_length=64,
+        blank=True,
+        db_index=True,
+        verbose_name='Хеш файла',
+        help_text='SHA-256 содержимого файла: дедупликация загрузок и продолжение индексации'
+    )
+    index_generation = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        verbose_name='Недописанное поколение',
+        help_text='Поколение, которое строит незавершенная индексация; повторный запуск продолжает его'
+    )
+    index_checkpoint = models.IntegerField(
+        default=-1,
+        verbose_name='Контрольная точка индексации',
+        help_text='Последний chunk_index, записанный в недописанное поколение'
+    )
+    
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Загружен')
     updated_at = models.DateTimeField(auto_now=True, verbose_name='Обновлен')
     
@@ -353,6 +416,13 @@ class KnowledgeBase(models.Model):
         return ", ".join([bot.name for bot in self.bots.all()])
 
 
+class KnowledgeChunkQuerySet(models.QuerySet):
+    
+    def active(self):
+        """Только фрагменты текущего (активного) поколения индексации документа"""
+        return self.filter(generation=models.F('knowledge_base__active_generation'))
+
+
 class KnowledgeChunk(models.Model):
     """Модель фрагмента документа с векторным представлением"""
     
@@ -364,14 +434,40 @@ class KnowledgeChunk(models.Model):
     )
     
     text = models.TextField(verbose_name='Текст фрагмента')
-    embedding = VectorField(dimensions=1536, verbose_name='Вектор')
+    # Тип, размерность и индекс колонки в БД задают RAG_EMBEDDING_STORAGE / RAG_EMBEDDING_DIMENSIONS
+    # через rag_convert_embeddings (в обход миграций); расхождение ловит проверка core.E001.
+    # Миграции AlterField/AddIndex для этого поля вернут схему к vector(1536) — после них
+    # команду нужно выполнить заново
+    embedding = VectorField(
+        dimensions=1536,
+        null=True,
+        verbose_name='Вектор',
+        help_text='Пусто, пока фрагмент ждет векторизации в распределенной индексации'
+    )
     chunk_index = models.IntegerField(
         verbose_name='Порядковый номер',
         help_text='Порядковый номер фрагмента в документе'
     )
+    generation = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Поколение индексации'
+    )
+    content_hash = models.CharField(
+        max_length=64,
+        blank=True,
+        verbose_name='Хеш текста',
+        help_text='SHA-256 текста фрагмента: неизмененные фрагменты не векторизуются повторно'
+    )
+    is_normalized = models.BooleanField(
+        default=False,
+        verbose_name='Вектор нормирован',
+        help_text='Вектор единичной длины: косинусная близость равна скалярному произведению'
+    )
     
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Создан')
     
+    objects = KnowledgeChunkQuerySet.as_manager()
+    
     class Meta:
         db_table = 'knowledge_chunks'
         verbose_name = 'Фрагмент документа'
@@ -379,12 +475,43 @@ class KnowledgeChunk(models.Model):
         ordering = ['knowledge_base', 'chunk_index']
         indexes = [
             models.Index(fields=['knowledge_base', 'chunk_index']),
+            models.Index(fields=['knowledge_base', 'generation']),
+            HnswIndex(
+                name='knowledge_chunks_embedding_hnsw',
+                fields=['embedding'],
+                m=16,
+                ef_construction=64,
+                opclasses=['vector_cosine_ops'],
+            ),
         ]
     
     def __str__(self):
         return f"Фрагмент {self.chunk_index} из {self.knowledge_base.title}"
 
 
+class SharedEmbedding(models.Model):
+    """
+    Общее хранилище векторов по содержимому: одинаковый текст фрагмента
+    в разных документах и у разных пользователей векторизуется один раз
+    """
+    
+    model = models.CharField(max_length=100, verbose_name='Модель эмбеддингов')
+    dimensions = models.PositiveIntegerField(verbose_name='Размерность')
+    text_hash = models.CharField(max_length=64, verbose_name='SHA-256 текста')
+    embedding = VectorField(verbose_name='Вектор')
+    
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Создан')
+    
+    class Meta:
+        db_table = 'shared_embeddings'
+        verbose_name = 'Общий вектор'
+        verbose_name_plural = 'Общие векторы'
+        unique_together = [['model', 'dimensions', 'text_hash']]
+    
+    def __str__(self):
+        return f"{self.model}/{self.dimensions}: {self.text_hash[:12]}"
+
+
 class Analytics(models.Model):
     """Модель для хранения аналитических данных"""
     
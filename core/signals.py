@@ -0,0 +1,70 @@
+# core/signals.py
+"""
+Сигналы для сброса кэшей RAG при изменении базы знаний
+"""
+
+from django.db import transaction
+from django.db.models.signals import post_save, pre_delete, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from .models import KnowledgeBase, KnowledgeChunk
+
+
+def _invalidate(bot_ids=(), kb_ids=()):
+    from services.rag_service import invalidate_bot_knowledge
+    
+    # Только после коммита: иначе параллельный поиск закэширует данные
+    # до переключения поколения под уже новой версией знаний
+    bot_ids, kb_ids = list(bot_ids), list(kb_ids)
+    transaction.on_commit(lambda: invalidate_bot_knowledge(bot_ids=bot_ids, kb_ids=kb_ids))
+
+
+@receiver(post_save, sender=KnowledgeChunk)
+def knowledge_chunk_saved(sender, instance, raw=False, **kwargs):
+    """Одиночные изменения чанков (например, из админки)"""
+    if not raw:
+        _invalidate(kb_ids=[instance.knowledge_base_id])
+
+
+@receiver(post_save, sender=KnowledgeBase)
+def knowledge_base_saved(sender, instance, raw=False, **kwargs):
+    """Документ сохраняется после каждой (пере)индексации"""
+    if not raw:
+        _invalidate(kb_ids=[instance.pk])
+
+
+@receiver(pre_delete, sender=KnowledgeBase)
+def knowledge_base_pre_delete(sender, instance, **kwargs):
+    # После удаления связи с ботами уже не прочитать — запоминаем заранее
+    instance._rag_bot_ids = list(instance.bots.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=KnowledgeBase)
+def knowledge_base_deleted(sender, instance, **kwargs):
+    _invalidate(bot_ids=getattr(instance, '_rag_bot_ids', []), kb_ids=[instance.pk])
+    
+    # Кэш текста общий для одинаковых файлов: удаляем вместе с последним документом
+    file_hash = instance.file_hash
+    if file_hash and not KnowledgeBase.objects.filter(file_hash=file_hash).exists():
+        transaction.on_commit(lambda: _remove_cached_text(file_hash))
+
+
+def _remove_cached_text(file_hash):
+    from services.rag_service import rag_service
+    if rag_service:
+        rag_service.file_reader.remove_cached(file_hash)
+
+
+@receiver(m2m_changed, sender=KnowledgeBase.bots.through)
+def knowledge_base_bots_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Назначение/отвязка документов от ботов"""
+    if action not in ('post_add', 'post_remove', 'pre_clear', 'post_clear'):
+        return
+    
+    if reverse:
+        # bot.knowledge_base.add(...): instance — бот
+        _invalidate(bot_ids=[instance.pk])
+    elif action == 'pre_clear':
+        _invalidate(bot_ids=list(instance.bots.values_list('id', flat=True)))
+    else:
+        _invalidate(bot_ids=pk_set or [], kb_ids=[instance.pk])
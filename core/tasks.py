@@ -3,61 +3,167 @@
 Celery задачи для асинхронной обработки
 """
 
-from celery import shared_task
+from celery import chord, shared_task
+from django.db import transaction
 from django.utils import timezone
 import logging
 
-from .models import KnowledgeBase
-from ..services.rag_service import rag_service
+from .models import KnowledgeBase, KnowledgeChunk
+from services.rag_service import rag_service, set_index_progress
 
 logger = logging.getLogger(__name__)
 
 
+def schedule_indexing(kb_id):
+    """
+    Ставит индексацию документа в очередь Celery.
+    Задача отправляется после коммита транзакции, чтобы воркер увидел запись и файл.
+    """
+    set_index_progress(kb_id, 'queued')
+    
+    def enqueue():
+        try:
+            index_document_async.delay(kb_id)
+        except Exception as e:
+            logger.error(f"Не удалось поставить индексацию {kb_id} в очередь: {e}")
+            set_index_progress(kb_id, 'error', error='Очередь задач недоступна')
+    
+    transaction.on_commit(enqueue)
+
+
 @shared_task(bind=True, max_retries=3)
-def index_document_async(self, kb_id, file_path):
+def index_document_async(self, kb_id, file_path=None):
     """
-    Асинхронная индексация документа
+    Асинхронная индексация документа.
+    Разбиение выполняется здесь, векторизация раздается chord'ом по диапазонам
+    чанков (embed_chunk_range), а finalize_indexing атомарно включает результат.
     
     Args:
         kb_id: ID документа в базе знаний
-        file_path: Путь к файлу
+        file_path: Путь к файлу (по умолчанию — файл документа)
         
     Returns:
-        dict: Результат индексации
+        dict: Результат подготовки индексации
     """
     try:
         logger.info(f"Начало индексации документа {kb_id}")
         
-        # Запускаем индексацию
-        chunks_count = rag_service.process_document(kb_id, file_path)
-        
-        # Обновляем запись в БД
-        kb = KnowledgeBase.objects.get(id=kb_id)
-        kb.chunks_count = chunks_count
-        kb.indexed_at = timezone.now()
-        kb.save()
-        
-        logger.info(f"Документ {kb_id} успешно проиндексирован. Создано {chunks_count} фрагментов")
+        if file_path is None:
+            kb = KnowledgeBase.objects.filter(id=kb_id).first()
+            if kb is None:
+                logger.warning(f"Документ {kb_id} удален до начала индексации")
+                return {'success': False, 'kb_id': kb_id}
+            file_path = kb.file.path
         
-        return {
-            'success': True,
-            'chunks_count': chunks_count,
-            'kb_id': kb_id
-        }
+        # Новые фрагменты пишутся без векторов (статус и прогресс обновляет сам сервис)
+        prepared = rag_service.prepare_document(kb_id, file_path)
         
     except Exception as e:
         logger.error(f"Ошибка индексации документа {kb_id}: {str(e)}")
         
         # Помечаем документ как не проиндексированный
         try:
-            kb = KnowledgeBase.objects.get(id=kb_id)
-            kb.is_indexed = False
-            kb.save()
+            KnowledgeBase.objects.filter(id=kb_id).update(is_indexed=False)
         except:
             pass
         
         # Повторная попытка
+        if self.request.retries < self.max_retries:
+            set_index_progress(kb_id, 'retrying', error=str(e), attempt=self.request.retries + 1)
         raise self.retry(exc=e, countdown=60)
+    
+    generation = prepared['generation']
+    finalize = finalize_indexing.si(
+        kb_id, generation, prepared['chunks_count'], prepared['reused'], prepared['pending']
+    )
+    
+    if not prepared['ranges']:
+        # Все фрагменты переиспользованы — векторизовать нечего
+        finalize.apply_async()
+    else:
+        chord(
+            embed_chunk_range.s(
+                kb_id, generation, start, end,
+                prepared['chunks_count'], prepared['pending'], len(prepared['reused'])
+            )
+            for start, end in prepared['ranges']
+        )(finalize.on_error(indexing_failed.s(kb_id, generation)))
+    
+    logger.info(
+        f"Документ {kb_id}: {prepared['pending']} фрагментов отправлено на векторизацию "
+        f"({len(prepared['ranges'])} задач)"
+    )
+    
+    return {
+        'success': True,
+        'chunks_count': prepared['chunks_count'],
+        'tasks': len(prepared['ranges']),
+        'kb_id': kb_id
+    }
+
+
+@shared_task(autoretry_for=(Exception,), retry_backoff=True, max_retries=5)
+def embed_chunk_range(kb_id, generation, start, end, chunks_count, pending, reused_count):
+    """
+    Векторизация фрагментов поколения с chunk_index в [start, end].
+    Упавший диапазон повторяется сам по себе, уже готовые векторы не пересчитываются.
+    """
+    embedded = rag_service.embed_pending_range(kb_id, generation, start, end)
+    
+    remaining = KnowledgeChunk.objects.filter(
+        knowledge_base_id=kb_id, generation=generation, embedding__isnull=True
+    ).count()
+    set_index_progress(
+        kb_id, 'running',
+        chunks=chunks_count, embedded=pending - remaining, pending=pending, reused=reused_count
+    )
+    
+    return embedded
+
+
+@shared_task
+def finalize_indexing(kb_id, generation, chunks_count, reused, pending):
+    """
+    Атомарное включение проиндексированного поколения:
+    is_indexed, chunks_count и набор фрагментов меняются одной транзакцией
+    """
+    activated = rag_service.finalize_document(
+        kb_id, generation, chunks_count, [tuple(pair) for pair in reused], pending
+    )
+    
+    if activated:
+        logger.info(f"Документ {kb_id} успешно проиндексирован. Создано {chunks_count} фрагментов")
+    
+    return {
+        'success': activated,
+        'chunks_count': chunks_count,
+        'kb_id': kb_id
+    }
+
+
+@shared_task
+def indexing_failed(request, exc, traceback, kb_id, generation):
+    """Обработчик ошибки chord'а: диапазон исчерпал повторы или включение не удалось"""
+    logger.error(f"Распределенная индексация документа {kb_id} не удалась: {exc}")
+    rag_service.abort_indexing(kb_id, generation, exc)
+
+
+@shared_task
+def prune_text_cache():
+    """
+    Ограничение кэша извлеченного текста по возрасту и общему размеру.
+    Запускается по расписанию через Celery Beat
+    """
+    from django.conf import settings
+    
+    removed, remaining = rag_service.file_reader.prune_cache(
+        max_bytes=getattr(settings, 'RAG_TEXT_CACHE_MAX_BYTES', 2 * 1024 ** 3),
+        max_age=getattr(settings, 'RAG_TEXT_CACHE_MAX_AGE', 30 * 24 * 3600),
+    )
+    
+    logger.info(f"Кэш текста: удалено {removed} записей, осталось {remaining} байт")
+    
+    return {'removed': removed, 'remaining_bytes': remaining}
 
 
 @shared_task
@@ -0,0 +1,50 @@
+# core/uploads.py
+"""
+Обработчики загрузки файлов: содержимое считается SHA-256 по мере приема,
+без повторного чтения файла (для дедупликации документов базы знаний)
+"""
+
+import hashlib
+
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+
+
+class ContentHashMixin:
+    """Считает SHA-256 принимаемых данных и кладет его в file_obj.content_hash"""
+    
+    def new_file(self, *args, **kwargs):
+        self.content_hash = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+    
+    def receive_data_chunk(self, raw_data, start):
+        # Неактивный обработчик памяти только передает данные дальше
+        if getattr(self, 'activated', True):
+            self.content_hash.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+    
+    def file_complete(self, file_size):
+        file_obj = super().file_complete(file_size)
+        if file_obj is not None:
+            file_obj.content_hash = self.content_hash.hexdigest()
+        return file_obj
+
+
+class HashingMemoryFileUploadHandler(ContentHashMixin, MemoryFileUploadHandler):
+    """Небольшие файлы — в памяти"""
+
+
+class HashingTemporaryFileUploadHandler(ContentHashMixin, TemporaryFileUploadHandler):
+    """Крупные файлы — потоково во временный файл на диске"""
+
+
+def uploaded_file_hash(uploaded_file) -> str:
+    """SHA-256 загруженного файла: посчитанный при приеме или по его частям"""
+    content_hash = getattr(uploaded_file, 'content_hash', None)
+    if content_hash:
+        return content_hash
+    
+    digest = hashlib.sha256()
+    for chunk in uploaded_file.chunks():
+        digest.update(chunk)
+    uploaded_file.seek(0)
+    return digest.hexdigest()
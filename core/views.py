@@ -15,7 +15,7 @@ from django.contrib.auth import login, logout, authenticate
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.contrib import messages
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
 from django.db.models import Count, Q, Avg, Sum
@@ -25,7 +25,11 @@ from django.core.paginator import Paginator
 
 # Импорты моделей и сервисов
 from .models import BotAgent, Conversation, Message, KnowledgeBase, KnowledgeChunk, Analytics
-from services.rag_service import rag_service
+from services.rag_service import (
+    rag_service, query_embedding_cache, retrieval_cache, semantic_answer_cache, get_index_progress,
+)
+from .tasks import schedule_indexing
+from .uploads import uploaded_file_hash
 
 from asgiref.sync import async_to_sync
 from .telegram_auth import send_code_request, verify_code
@@ -46,6 +50,20 @@ def get_file_type(filename):
         return ext.replace('.', '')
     return 'other'
 
+def find_duplicate_document(user, content_hash):
+    """Уже загруженный пользователем документ с тем же содержимым (проиндексированные — в приоритете)"""
+    return KnowledgeBase.objects.filter(
+        user=user, file_hash=content_hash
+    ).order_by('-is_indexed', '-created_at').first()
+
+def reindex_if_stalled(kb):
+    """Непроиндексированный документ без идущей индексации (например, упавшей) ставится в очередь заново"""
+    if kb.is_indexed:
+        return
+    progress = get_index_progress(kb.id) or {}
+    if progress.get('status') not in ('queued', 'running', 'retrying'):
+        schedule_indexing(kb.id)
+
 # ============================================
 # PUBLIC PAGES
 # ============================================
@@ -679,7 +697,7 @@ def knowledge_base_list(request):
     # Статистика
     total_files = KnowledgeBase.objects.filter(user=request.user).count()
     indexed_files = KnowledgeBase.objects.filter(user=request.user, is_indexed=True).count()
-    total_chunks = KnowledgeChunk.objects.filter(knowledge_base__user=request.user).count()
+    total_chunks = KnowledgeChunk.objects.active().filter(knowledge_base__user=request.user).count()
     
     # Список ботов пользователя для фильтра
     user_bots = BotAgent.objects.filter(user=request.user)
@@ -739,7 +757,7 @@ def bot_knowledge_base(request, bot_id):
     # Статистика для этого бота
     total_files = files.count()
     indexed_files = files.filter(is_indexed=True).count()
-    total_chunks = KnowledgeChunk.objects.filter(knowledge_base__bots=bot).count()
+    total_chunks = KnowledgeChunk.objects.active().filter(knowledge_base__bots=bot).count()
     
     context = {
         'bot': bot,
@@ -783,33 +801,37 @@ def upload_knowledge_file(request):
             return redirect('knowledge_base_list')
         
         try:
-            # Создаем запись
-            kb = KnowledgeBase.objects.create(
-                user=request.user,
-                title=title,
-                description=description,
-                file=uploaded_file,
-                file_type=file_ext[1:],
-                file_size=uploaded_file.size,
-                is_indexed=False  # ← Явно устанавливаем в False до индексации
-            )
-            
-            # Назначаем ботам
-            if bot_ids:
-                bots = BotAgent.objects.filter(id__in=bot_ids, user=request.user)
-                kb.bots.set(bots)
+            content_hash = uploaded_file_hash(uploaded_file)
+            duplicate = find_duplicate_document(request.user, content_hash)
             
-            # Индексация RAG
-            file_path = kb.file.path
-            chunks_count = rag_service.process_document(kb.id, file_path)
-            
-            # ← ИСПРАВЛЕНИЕ: Правильно обновляем статус индексации
-            kb.chunks_count = chunks_count
-            kb.is_indexed = True  # ← Теперь явно устанавливаем в True
-            kb.indexed_at = timezone.now()
-            kb.save()
-            
-            messages.success(request, f'✅ Файл "{title}" загружен и проиндексирован ({chunks_count} фрагментов)')
+            if duplicate:
+                # Тот же файл уже загружен: подключаем документ к ботам без разбора и векторизации
+                if bot_ids:
+                    duplicate.bots.add(*BotAgent.objects.filter(id__in=bot_ids, user=request.user))
+                reindex_if_stalled(duplicate)
+                messages.info(request, f'Файл уже загружен как "{duplicate.title}" — документ подключен к выбранным ботам')
+            else:
+                # Создаем запись
+                kb = KnowledgeBase.objects.create(
+                    user=request.user,
+                    title=title,
+                    description=description,
+                    file=uploaded_file,
+                    file_type=file_ext[1:],
+                    file_size=uploaded_file.size,
+                    file_hash=content_hash,
+                    is_indexed=False  # ← Явно устанавливаем в False до индексации
+                )
+                
+                # Назначаем ботам
+                if bot_ids:
+                    bots = BotAgent.objects.filter(id__in=bot_ids, user=request.user)
+                    kb.bots.set(bots)
+                
+                # Индексация RAG в фоне (статус, chunks_count и indexed_at обновляет сам сервис)
+                schedule_indexing(kb.id)
+                
+                messages.success(request, f'✅ Файл "{title}" загружен, индексация запущена')
             
         except Exception as e:
             logger.error(f"Ошибка при загрузке: {str(e)}")
@@ -841,7 +863,7 @@ def knowledge_detail(request, kb_id):
     kb = get_object_or_404(KnowledgeBase, id=kb_id, user=request.user)
     
     # Получаем несколько примеров чанков
-    sample_chunks = kb.chunks.all()[:10]
+    sample_chunks = kb.chunks.active()[:10]
     
     # Боты, использующие этот файл
     assigned_bots = kb.bots.all()
@@ -852,7 +874,7 @@ def knowledge_detail(request, kb_id):
     context = {
         'kb': kb,
         'sample_chunks': sample_chunks,
-        'total_chunks': kb.chunks.count(),
+        'total_chunks': kb.chunks.active().count(),
         'assigned_bots': assigned_bots,
         'all_user_bots': all_user_bots,
     }
@@ -919,6 +941,25 @@ def assign_bots_to_knowledge(request, kb_id):
 # API: ПЕРЕИНДЕКСАЦИЯ
 # ============================================
 
+@login_required
+@require_http_methods(['GET'])
+def knowledge_index_status(request, kb_id):
+    """API: Прогресс фоновой индексации документа"""
+    kb = get_object_or_404(KnowledgeBase, id=kb_id, user=request.user)
+    
+    progress = get_index_progress(kb.id)
+    if progress is None:
+        # Записи о прогрессе нет (истекла или индексация была до фоновой очереди)
+        progress = {'status': 'done' if kb.is_indexed else 'unknown'}
+    
+    return JsonResponse({
+        'success': True,
+        'is_indexed': kb.is_indexed,
+        'chunks_count': kb.chunks_count,
+        'progress': progress,
+    })
+
+
 @login_required
 @require_http_methods(['POST'])
 def reindex_knowledge_base(request, kb_id):
@@ -926,21 +967,13 @@ def reindex_knowledge_base(request, kb_id):
     kb = get_object_or_404(KnowledgeBase, id=kb_id, user=request.user)
     
     try:
-        # Удаляем старые чанки
-        kb.chunks.all().delete()
-        
-        # Переиндексируем
-        chunks_count = rag_service.process_document(kb.id, kb.file.path)
-        
-        kb.chunks_count = chunks_count
-        kb.indexed_at = timezone.now()
-        kb.is_indexed = True
-        kb.save()
+        # Переиндексируем в фоне: старые чанки остаются доступны поиску до атомарной замены
+        schedule_indexing(kb.id)
         
         return JsonResponse({
             'success': True,
-            'message': f'Переиндексировано: {chunks_count} чанков',
-            'chunks_count': chunks_count
+            'message': 'Переиндексация запущена',
+            'status_url': f'/api/knowledge/{kb.id}/status/'
         })
         
     except Exception as e:
@@ -957,6 +990,30 @@ def test_rag_search(request, bot_id):
     try:
         data = json.loads(request.body)
         query = data.get('query', '')
+        queries = data.get('queries')
+        
+        if queries:
+            # Пакетная проверка поиска (без генерации ответов)
+            if not isinstance(queries, list) or len(queries) > 100:
+                return JsonResponse({'success': False, 'error': 'queries: список до 100 строк'}, status=400)
+            
+            queries = [str(q) for q in queries]
+            top_k = int(data.get('top_k', bot.rag_top_k))
+            results = rag_service.search_many(bot.id, queries, top_k=top_k)
+            
+            return JsonResponse({
+                'success': True,
+                'results': [
+                    {
+                        'query': q,
+                        'chunks': [
+                            {'text': r['text'][:300], 'source': r['source'], 'similarity': r['similarity']}
+                            for r in found
+                        ]
+                    }
+                    for q, found in zip(queries, results)
+                ]
+            })
         
         if not query:
             return JsonResponse({'success': False, 'error': 'Empty query'}, status=400)
@@ -975,6 +1032,34 @@ def test_rag_search(request, bot_id):
         logger.error(f"RAG test error: {e}")
         return JsonResponse({'success': False, 'error': str(e)}, status=500)
     
+
+@login_required
+@require_http_methods(['GET'])
+def rag_cache_stats(request):
+    """API: Статистика кэшей RAG (для мониторинга, только staff)"""
+    if not request.user.is_staff:
+        return JsonResponse({'success': False, 'error': 'Forbidden'}, status=403)
+    
+    return JsonResponse({
+        'success': True,
+        'query_embeddings': query_embedding_cache.get_stats(),
+        'retrieval': retrieval_cache.get_stats(),
+    })
+
+
+@login_required
+@require_http_methods(['GET'])
+def bot_answer_cache_stats(request, bot_id):
+    """API: Попадания семантического кэша ответов бота и сэкономленные токены"""
+    bot = get_object_or_404(BotAgent, id=bot_id, user=request.user)
+    
+    return JsonResponse({
+        'success': True,
+        'enabled': bot.answer_cache_enabled,
+        'threshold': bot.answer_cache_threshold,
+        'stats': semantic_answer_cache.get_stats(bot.id),
+    })
+    
 # ============================================
 # TELEGRAM CONNECT
 # ============================================
@@ -1221,22 +1306,37 @@ def upload_knowledge_api(request, bot_id):
         if file_ext not in ALLOWED_EXTENSIONS:
              return JsonResponse({'success': False, 'message': 'Неверный формат'}, status=400)
 
+        content_hash = uploaded_file_hash(uploaded_file)
+        duplicate = find_duplicate_document(request.user, content_hash)
+        if duplicate:
+            # Повторная загрузка того же файла — только привязка к боту
+            duplicate.bots.add(bot)
+            reindex_if_stalled(duplicate)
+            return JsonResponse({
+                'success': True,
+                'kb_id': duplicate.id,
+                'duplicate': True,
+                'status_url': f'/api/knowledge/{duplicate.id}/status/'
+            })
+
         kb = KnowledgeBase.objects.create(
             user=request.user,  # Обязательно указываем владельца
             title=uploaded_file.name, 
             file=uploaded_file,
             file_type=file_ext[1:], 
-            file_size=uploaded_file.size
+            file_size=uploaded_file.size,
+            file_hash=content_hash
         )
         
         kb.bots.add(bot)
         
-        chunks_count = rag_service.process_document(kb.id, kb.file.path)
-        kb.chunks_count = chunks_count
-        kb.indexed_at = timezone.now()
-        kb.save()
+        schedule_indexing(kb.id)
         
-        return JsonResponse({'success': True, 'chunks': chunks_count})
+        return JsonResponse({
+            'success': True,
+            'kb_id': kb.id,
+            'status_url': f'/api/knowledge/{kb.id}/status/'
+        }, status=202)
         
     except BotAgent.DoesNotExist:
         return JsonResponse({'success': False, 'message': 'Бот не найден'}, status=404)
@@ -1319,6 +1419,17 @@ def send_message_api(request, bot_id):
         if history and history[-1]['content'] == message_text:
             history = history[:-1]
         
+        if data.get('stream') or 'text/event-stream' in request.headers.get('Accept', ''):
+            # Ответ по мере генерации (Server-Sent Events)
+            top_k = bot.rag_top_k if bot.use_rag else 0
+            response = StreamingHttpResponse(
+                stream_bot_reply(bot, conversation, message_text, top_k, history),
+                content_type='text/event-stream'
+            )
+            response['Cache-Control'] = 'no-cache'
+            response['X-Accel-Buffering'] = 'no'  # nginx не должен буферизовать поток
+            return response
+        
         if bot.use_rag:
             result = rag_service.answer_question(bot.id, message_text, top_k=bot.rag_top_k, history=history)
             bot_response = result['answer']
@@ -1339,6 +1450,21 @@ def send_message_api(request, bot_id):
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
+def stream_bot_reply(bot, conversation, message_text, top_k, history):
+    """SSE-события ответа бота; итоговый ответ сохраняется в диалог после генерации"""
+    for event in rag_service.stream_answer(bot.id, message_text, top_k=top_k, history=history):
+        if event['type'] == 'done':
+            Message.objects.create(conversation=conversation, role='bot', content=event['answer'])
+            conversation.last_message_at = timezone.now()
+            conversation.save(update_fields=['last_message_at'])
+            event = {
+                'type': 'done',
+                'success': True,
+                'response': event['answer'],
+                'sources': event.get('sources', []) if bot.use_rag else [],
+            }
+        yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
 @login_required
 def settings_view(request):
     """Настройки аккаунта"""
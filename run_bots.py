@@ -10,6 +10,8 @@ import sys
 import django
 import logging
 import random
+import re
+import time
 from asgiref.sync import sync_to_async
 import json
 import threading
@@ -37,12 +39,14 @@ django.setup()
 from django.utils import timezone
 from core.models import BotAgent, Conversation, Message as MessageModel
 from services.rag_service import rag_service
+from services.openai_client import get_openai_client, get_async_openai_client
 
-from telethon import TelegramClient, events, functions
+from telethon import TelegramClient, events, functions, types
+from telethon.errors import FloodWaitError, MessageNotModifiedError
 from telethon.sessions import StringSession
 
 try:
-    from openai import OpenAI, OpenAIError
+    from openai import OpenAIError
     OPENAI_AVAILABLE = True
 except ImportError:
     OPENAI_AVAILABLE = False
@@ -62,7 +66,8 @@ ai_client = None
 
 if OPENAI_AVAILABLE and OPENAI_API_KEY:
     try:
-        ai_client = OpenAI(api_key=OPENAI_API_KEY)
+        # Общий пул соединений процесса (тот же, что у RAG-сервиса)
+        ai_client = get_openai_client('chat')
         logger.info("✅ OpenAI client initialized")
     except Exception as e:
         logger.error(f"❌ Failed to initialize OpenAI: {e}")
@@ -76,6 +81,11 @@ accumulators = {}
 # Время ожидания следующего сообщения (в секундах)
 MESSAGE_DEBOUNCE_DELAY = 15 
 
+# Потоковые ответы: первое предложение отправляется сразу, остальное дописывается правками
+STREAM_REPLIES = os.getenv('STREAM_REPLIES', '1') == '1'
+STREAM_EDIT_INTERVAL = 1.5  # секунд между правками одного сообщения (flood-лимиты Telegram)
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+
 # --- PROMPT TEMPLATES ---
 HUMANIZER_INSTRUCTIONS_TEMPLATE = """
 Роль: Ты — {bot_name}, сотрудник {company_name}. Пишешь с телефона в Telegram.
@@ -145,25 +155,137 @@ def get_conversation_history(conversation_id, limit=10):
         
     return formatted_history
 
-@sync_to_async
-def get_rag_response(bot_id, query):
+async def get_rag_context(bot_id, query, top_k=5):
+    """Только поиск по базе знаний: ответ генерируется одним вызовом в get_chatgpt_response"""
     try:
-        result = rag_service.answer_question(bot_id, query, top_k=5)
-        return result
+        return await rag_service.aretrieve_context(bot_id, query, top_k=top_k)
     except Exception as e:
         logger.error(f"RAG Error for bot {bot_id}: {e}")
         return {
-            'answer': None,
+            'text': "",
             'sources': [],
-            'confidence': 0.0
+            'confidence': 0.0,
+            'tokens': 0
         }
 
+# --- STREAMING ---
+
+class TelegramReplyStream:
+    """
+    Постепенная доставка ответа в Telegram: первое предложение отправляется сразу,
+    дальше сообщение дописывается правками не чаще STREAM_EDIT_INTERVAL,
+    а при превышении лимита длины ответ продолжается новым сообщением.
+    """
+    FIRST_SENTENCE = re.compile(r'[.!?…]\s|\n')
+
+    def __init__(self, client, chat_id):
+        self.client = client
+        self.chat_id = chat_id
+        self.text = ""  # весь полученный текст
+        self.offset = 0  # начало текста текущего сообщения
+        self.message = None  # текущее сообщение, которое дописываем
+        self.shown = ""  # что сейчас видно в self.message
+        self.started = False
+        self.next_edit = 0.0
+
+    async def feed(self, delta):
+        self.text += delta
+        if not self.started:
+            if self.FIRST_SENTENCE.search(self.text):
+                self.started = True
+                await self._flush()
+            return
+        if time.monotonic() >= self.next_edit:
+            await self._flush()
+
+    async def finish(self, final_text):
+        """Дописывает остаток; final_text — итог get_chatgpt_response"""
+        final_text = (final_text or "").strip()
+        if not self.started:
+            # Еще ничего не отправлено — отправляем итог целиком
+            self.text = final_text
+            await self._flush(wait=True)
+        elif self.text.strip().endswith(final_text):
+            await self._flush(wait=True)
+        else:
+            # Генерация оборвалась (ошибка): отправленное оставляем, итог — отдельным сообщением
+            await self._flush(wait=True)
+            self.text, self.offset, self.message, self.shown = final_text, 0, None, ""
+            await self._flush(wait=True)
+
+    async def _flush(self, wait=False):
+        segment = self.text[self.offset:]
+        while len(segment.strip()) > TELEGRAM_MAX_MESSAGE_LENGTH:
+            cut = segment.rfind('\n', 0, TELEGRAM_MAX_MESSAGE_LENGTH)
+            if cut <= 0:
+                cut = segment.rfind(' ', 0, TELEGRAM_MAX_MESSAGE_LENGTH)
+            if cut <= 0:
+                cut = TELEGRAM_MAX_MESSAGE_LENGTH
+            await self._show(segment[:cut], wait=True)
+            self.offset += cut
+            self.message, self.shown = None, ""
+            segment = self.text[self.offset:]
+        await self._show(segment, wait=wait)
+
+    async def _show(self, text, wait=False):
+        text = text.strip()
+        if not text or text == self.shown:
+            return
+        try:
+            if self.message is None:
+                self.message = await self.client.send_message(self.chat_id, text)
+            else:
+                await self.client.edit_message(self.chat_id, self.message, text)
+            self.shown = text
+        except MessageNotModifiedError:
+            self.shown = text
+        except FloodWaitError as e:
+            logger.warning(f"⏳ FloodWait {e.seconds}s while streaming reply")
+            self.next_edit = time.monotonic() + e.seconds
+            if wait:
+                await asyncio.sleep(e.seconds)
+                await self._show(text, wait=False)
+            return
+        except Exception as e:
+            logger.error(f"❌ Failed to stream reply: {e}")
+        self.next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+
+
+async def stream_completion(api_params, on_delta):
+    """
+    Потоковый запрос к OpenAI: текст передается в on_delta по мере генерации,
+    вызовы функций собираются из дельт. Возвращает (текст, [{'id', 'name', 'arguments'}])
+    """
+    stream = await get_async_openai_client('chat').chat.completions.create(**api_params, stream=True)
+
+    content = []
+    tool_calls = {}
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if delta.content:
+            content.append(delta.content)
+            await on_delta(delta.content)
+        for call_delta in delta.tool_calls or []:
+            call = tool_calls.setdefault(call_delta.index, {'id': None, 'name': '', 'arguments': ''})
+            if call_delta.id:
+                call['id'] = call_delta.id
+            if call_delta.function:
+                call['name'] += call_delta.function.name or ''
+                call['arguments'] += call_delta.function.arguments or ''
+
+    return "".join(content), [tool_calls[index] for index in sorted(tool_calls)]
+
+
 # --- AI CORE LOGIC ---
 
-async def get_chatgpt_response(message_text, bot_record, history=None, conversation_id=None, telegram_client=None):
+async def get_chatgpt_response(message_text, bot_record, history=None, conversation_id=None, telegram_client=None,
+                               on_delta=None):
     """
     Генерация ответа с поддержкой Function Calling и Humanizer.
     telegram_client: Активное соединение для отправки уведомлений без конфликтов.
+    on_delta: async-колбэк для потоковой выдачи текста по мере генерации.
     """
     if not ai_client:
         return "⚠️ Ошибка: AI клиент не инициализирован."
@@ -180,15 +302,39 @@ async def get_chatgpt_response(message_text, bot_record, history=None, conversat
         
         user_prompt = bot_record.system_prompt or ""
         
+        # Исключаем дублирование последнего сообщения истории, если оно уже там
+        msgs_to_add = history or []
+        if msgs_to_add and msgs_to_add[-1]['role'] == 'user' and msgs_to_add[-1]['content'] == message_text:
+            msgs_to_add = msgs_to_add[:-1]
+        
+        # 1.1. Инструменты (Functions): загружаются заранее — кэш ответов только для ботов без них
+        bot_functions = await sync_to_async(list)(
+            BotFunction.objects.filter(bot=bot_record, is_active=True)
+        )
+        tools = [func.to_openai_tool() for func in bot_functions]
+        
+        # 1.2. Семантический кэш ответов: самостоятельный вопрос к боту без инструментов
+        cache_vector = None
+        if rag_service and not tools:
+            cached, cache_vector = await rag_service.alookup_answer(
+                bot_record, message_text, bot_record.rag_top_k, msgs_to_add
+            )
+            if cached:
+                logger.info(f"♻️ [Bot {bot_record.id}] Answer from semantic cache")
+                if on_delta:
+                    await on_delta(cached['answer'])
+                return cached['answer']
+        
         # 2. RAG (База знаний)
         rag_context = ""
+        rag_result = None
         if bot_record.use_rag:
             logger.info(f"🔍 [Bot {bot_record.id}] Searching knowledge base...")
-            rag_result = await get_rag_response(bot_record.id, message_text)
+            rag_result = await get_rag_context(bot_record.id, message_text, top_k=bot_record.rag_top_k)
             
-            if rag_result and rag_result.get('answer'):
-                rag_context = f"\n\n📚 ИНФОРМАЦИЯ ИЗ БАЗЫ ЗНАНИЙ:\n{rag_result['answer']}\n"
-                logger.info(f"✅ [Bot {bot_record.id}] RAG found info")
+            if rag_result and rag_result.get('text'):
+                rag_context = f"\n\n📚 ИНФОРМАЦИЯ ИЗ БАЗЫ ЗНАНИЙ:\n{rag_result['text']}\n"
+                logger.info(f"✅ [Bot {bot_record.id}] RAG found info (~{rag_result['tokens']} токенов)")
         
         # 3. Сборка финального промпта
         final_system_prompt = humanizer + "\n\n" + user_prompt
@@ -198,22 +344,9 @@ async def get_chatgpt_response(message_text, bot_record, history=None, conversat
         
         # Формируем историю сообщений
         messages_payload = [{"role": "system", "content": final_system_prompt}]
-        
-        if history:
-            msgs_to_add = history
-            # Исключаем дублирование последнего сообщения, если оно уже там
-            if history and history[-1]['role'] == 'user' and history[-1]['content'] == message_text:
-                msgs_to_add = history[:-1]
-            messages_payload.extend(msgs_to_add)
-        
+        messages_payload.extend(msgs_to_add)
         messages_payload.append({"role": "user", "content": message_text})
         
-        # 4. Загрузка инструментов (Functions)
-        bot_functions = await sync_to_async(list)(
-            BotFunction.objects.filter(bot=bot_record, is_active=True)
-        )
-        tools = [func.to_openai_tool() for func in bot_functions]
-        
         logger.info(f"[Bot {bot_record.name}] Model: {bot_record.openai_model} | Tools: {len(tools)}")
         
         loop = asyncio.get_event_loop()
@@ -233,22 +366,42 @@ async def get_chatgpt_response(message_text, bot_record, history=None, conversat
              api_params["max_tokens"] = bot_record.max_tokens
 
         # 5. ПЕРВЫЙ ЗАПРОС К OPENAI
-        response = await loop.run_in_executor(
-            None,
-            lambda: ai_client.chat.completions.create(**api_params)
-        )
-        
-        message = response.choices[0].message
+        usage = None
+        if on_delta:
+            content, tool_calls = await stream_completion(api_params, on_delta)
+            assistant_message = {"role": "assistant", "content": content or None}
+            if tool_calls:
+                assistant_message["tool_calls"] = [
+                    {
+                        "id": call['id'],
+                        "type": "function",
+                        "function": {"name": call['name'], "arguments": call['arguments']}
+                    }
+                    for call in tool_calls
+                ]
+        else:
+            response = await loop.run_in_executor(
+                None,
+                lambda: ai_client.chat.completions.create(**api_params)
+            )
+            usage = getattr(response, 'usage', None)
+            
+            assistant_message = response.choices[0].message
+            content = assistant_message.content or ""
+            tool_calls = [
+                {'id': call.id, 'name': call.function.name, 'arguments': call.function.arguments}
+                for call in assistant_message.tool_calls or []
+            ]
         
         # 6. ОБРАБОТКА FUNCTION CALLING
-        if message.tool_calls:
-            logger.info(f"🔧 [Bot {bot_record.id}] AI wants to call {len(message.tool_calls)} function(s)")
+        if tool_calls:
+            logger.info(f"🔧 [Bot {bot_record.id}] AI wants to call {len(tool_calls)} function(s)")
             
-            messages_payload.append(message)
+            messages_payload.append(assistant_message)
             
-            for tool_call in message.tool_calls:
-                function_name = tool_call.function.name
-                function_args = json.loads(tool_call.function.arguments)
+            for tool_call in tool_calls:
+                function_name = tool_call['name']
+                function_args = json.loads(tool_call['arguments'])
                 
                 logger.info(f"⚙️ Calling: {function_name} with {function_args}")
                 
@@ -262,7 +415,7 @@ async def get_chatgpt_response(message_text, bot_record, history=None, conversat
                 
                 messages_payload.append({
                     "role": "tool",
-                    "tool_call_id": tool_call.id,
+                    "tool_call_id": tool_call['id'],
                     "name": function_name,
                     "content": json.dumps(result, ensure_ascii=False)
                 })
@@ -275,6 +428,10 @@ async def get_chatgpt_response(message_text, bot_record, history=None, conversat
             if not uses_new_api:
                 final_api_params["temperature"] = bot_record.temperature
                 final_api_params["max_tokens"] = bot_record.max_tokens
+            
+            if on_delta:
+                final_content, _ = await stream_completion(final_api_params, on_delta)
+                return final_content.strip()
                 
             final_response = await loop.run_in_executor(
                 None,
@@ -283,7 +440,13 @@ async def get_chatgpt_response(message_text, bot_record, history=None, conversat
             
             return final_response.choices[0].message.content.strip()
         
-        return message.content.strip()
+        answer = content.strip()
+        if cache_vector is not None and answer:
+            context = rag_result or {'sources': [], 'confidence': 0.0, 'tokens': 0}
+            await rag_service.astore_answer(
+                bot_record, cache_vector, bot_record.rag_top_k, answer, context, usage
+            )
+        return answer
         
     except Exception as e:
         logger.error(f"OpenAI Error: {e}")
@@ -339,6 +502,31 @@ async def process_accumulated_messages(bot_record, user_id, conversation, client
         if match:
             history_for_ai = raw_history[:-len(messages_to_process)]
 
+    if STREAM_REPLIES:
+        # Ответ уходит по мере генерации: вместо имитации печати пользователь ждет только первое предложение
+        try:
+            await client(functions.messages.SetTypingRequest(peer=chat_id, action=types.SendMessageTypingAction()))
+        except Exception:
+            pass
+
+        stream = TelegramReplyStream(client, chat_id)
+        response_text = await get_chatgpt_response(
+            combined_text,
+            bot_record,
+            history=history_for_ai,
+            conversation_id=conversation.id,
+            telegram_client=client,
+            on_delta=stream.feed
+        )
+
+        try:
+            await stream.finish(response_text)
+            await save_message_to_db(conversation, 'bot', response_text)
+            logger.info(f"✅ [{bot_record.name}] Streamed reply to group messages")
+        except Exception as e:
+            logger.error(f"❌ Failed to send reply: {e}")
+        return
+
     response_text = await get_chatgpt_response(
         combined_text, 
         bot_record,
@@ -468,6 +656,7 @@ async def monitor_manager():
     logger.info(f"📚 RAG Service: {'✅ Available' if rag_service else '❌ Not available'}")
     logger.info(f"🤖 HUMANIZER: ENABLED with Group Response")
     logger.info(f"⏱️ DEBOUNCE DELAY: {MESSAGE_DEBOUNCE_DELAY}s")
+    logger.info(f"📡 STREAMING REPLIES: {'ON' if STREAM_REPLIES else 'OFF'}")
     
     while True:
         try:
@@ -0,0 +1,91 @@
+# services/openai_client.py
+"""
+Общие клиенты OpenAI на процесс.
+Все вызовы (эмбеддинги, ответы, function calling) идут через один пул keep-alive
+соединений с явными лимитами, таймаутами и политикой повторов, поэтому
+при всплесках нагрузки не платим за новые TLS-рукопожатия.
+"""
+
+import asyncio
+import importlib.util
+import logging
+import threading
+import weakref
+from typing import Dict
+
+import httpx
+from django.conf import settings
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_sync_clients: Dict[str, OpenAI] = {}
+# Асинхронный пул httpx привязан к циклу событий, в котором создан
+_async_clients = weakref.WeakKeyDictionary()  # loop -> {purpose: AsyncOpenAI}
+
+
+def _http_options() -> Dict:
+    http2 = getattr(settings, 'OPENAI_HTTP2', True) and importlib.util.find_spec('h2') is not None
+    return {
+        'limits': httpx.Limits(
+            max_connections=getattr(settings, 'OPENAI_MAX_CONNECTIONS', 100),
+            max_keepalive_connections=getattr(settings, 'OPENAI_MAX_KEEPALIVE_CONNECTIONS', 20),
+            keepalive_expiry=getattr(settings, 'OPENAI_KEEPALIVE_EXPIRY', 60),
+        ),
+        'http2': http2,
+    }
+
+
+def _timeout(purpose: str) -> httpx.Timeout:
+    timeouts = getattr(settings, 'OPENAI_TIMEOUTS', {})
+    read = timeouts.get(purpose, timeouts.get('default', 60.0))
+    return httpx.Timeout(read, connect=getattr(settings, 'OPENAI_CONNECT_TIMEOUT', 5.0))
+
+
+def _client_options() -> Dict:
+    return {
+        'api_key': settings.OPENAI_API_KEY,
+        'max_retries': getattr(settings, 'OPENAI_MAX_RETRIES', 2),
+    }
+
+
+def get_openai_client(purpose: str = 'default') -> OpenAI:
+    """
+    Синхронный клиент процесса. purpose ('embeddings', 'chat', ...) выбирает таймаут
+    из OPENAI_TIMEOUTS; клиенты разных назначений делят один пул соединений.
+    """
+    client = _sync_clients.get(purpose)
+    if client is not None:
+        return client
+    
+    with _lock:
+        if 'default' not in _sync_clients:
+            _sync_clients['default'] = OpenAI(
+                http_client=DefaultHttpxClient(**_http_options()),
+                timeout=_timeout('default'),
+                **_client_options()
+            )
+            logger.info(f"OpenAI client initialized (http2={_http_options()['http2']})")
+        if purpose not in _sync_clients:
+            _sync_clients[purpose] = _sync_clients['default'].with_options(timeout=_timeout(purpose))
+        return _sync_clients[purpose]
+
+
+def get_async_openai_client(purpose: str = 'default') -> AsyncOpenAI:
+    """Асинхронный клиент для текущего цикла событий (вызывать внутри корутины)"""
+    loop = asyncio.get_running_loop()
+    
+    with _lock:
+        clients = _async_clients.get(loop)
+        if clients is None:
+            clients = _async_clients[loop] = {
+                'default': AsyncOpenAI(
+                    http_client=DefaultAsyncHttpxClient(**_http_options()),
+                    timeout=_timeout('default'),
+                    **_client_options()
+                )
+            }
+        if purpose not in clients:
+            clients[purpose] = clients['default'].with_options(timeout=_timeout(purpose))
+        return clients[purpose]
@@ -1,11 +1,27 @@
 # services/rag_service.py - С ПОДДЕРЖКОЙ НОВОГО API
 
+import csv
+import functools
+import hashlib
+import io
 import logging
-from typing import List, Dict
+import os
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Dict, Tuple, Iterable, Iterator, Optional
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from openai import OpenAI
+from django.core.cache import cache
+from openai import OpenAI, AsyncOpenAI
 import numpy as np
 
+from services.openai_client import get_openai_client, get_async_openai_client
+
 logger = logging.getLogger(__name__)
 
 # ========== HUMANIZER TEMPLATE ==========
@@ -36,58 +52,352 @@ HUMANIZER_INSTRUCTIONS_TEMPLATE = """
 """
 
 
+# Конфигурация полнотекстового поиска; должна совпадать с генерируемой колонкой
+# knowledge_chunks.search_vector (миграция 0010)
+RAG_FTS_CONFIG = 'simple'
+
+
+def hash_text(text: str) -> str:
+    """Хеш содержимого фрагмента (SHA-256)"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def hash_file(file_path: str, block_size: int = 1024 * 1024) -> str:
+    """Хеш содержимого файла (SHA-256), читается блоками"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def estimate_tokens(text: str) -> int:
+    # Консервативная оценка: кириллица дает ~1 токен на 2-3 символа
+    return len(text) // 2 + 1
+
+
+def normalize_vector(vector: Iterable[float]) -> np.ndarray:
+    """Единичный float32-вектор; нулевой (ошибка эмбеддинга) возвращается как есть"""
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def with_db_connection(func):
+    """
+    Обертка для вызова из пула потоков (sync_to_async(thread_sensitive=False)):
+    у каждого потока свое соединение с БД, и вне цикла запросов Django его никто
+    не проверяет. Как в обработке запроса, устаревшие и сломанные соединения
+    закрываются до и после вызова.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        from django.db import close_old_connections
+        
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return wrapper
+
+
+def _extract_pdf_pages(file_path: str, start: int, end: int) -> List[str]:
+    """Извлекает текст страниц [start, end) — выполняется в процессе пула"""
+    from pypdf import PdfReader
+    
+    reader = PdfReader(file_path)
+    return [reader.pages[i].extract_text() or "" for i in range(start, end)]
+
+
 class FileReader:
     """Читает разные форматы файлов"""
     
+    # Версия извлечения текста: увеличить при изменении _iter_pdf / _iter_docx,
+    # чтобы кэш извлеченного текста пересобрался
+    EXTRACTOR_VERSION = 1
+    
+    def __init__(self, pdf_workers: int = None, pdf_pages_per_task: int = None, cache_dir: str = None):
+        # pdf_workers > 1 включает параллельное извлечение текста PDF в пуле процессов
+        self.pdf_workers = pdf_workers or getattr(settings, 'RAG_PDF_WORKERS', 1)
+        self.pdf_pages_per_task = pdf_pages_per_task or getattr(settings, 'RAG_PDF_PAGES_PER_TASK', 20)
+        # Пустой cache_dir отключает кэш извлеченного текста
+        self.cache_dir = cache_dir if cache_dir is not None else getattr(settings, 'RAG_TEXT_CACHE_DIR', '')
+    
     def read_file(self, file_path: str) -> str:
-        """Универсальный читатель файлов"""
-        import os
+        """Универсальный читатель файлов (весь текст целиком)"""
+        return "\n".join(self.iter_text(file_path))
+    
+    def iter_text(self, file_path: str, file_hash: str = None) -> Iterator[str]:
+        """
+        Потоковое чтение: отдает текст по страницам / параграфам / строкам.
+        Текст PDF и DOCX кэшируется на диске по хешу файла (file_hash, если уже посчитан).
+        """
         from pathlib import Path
         
         file_ext = Path(file_path).suffix.lower()
         
         if file_ext in ['.txt', '.md', '.csv']:
-            logger.info(f"Чтение файла: {file_path}")
+            return self._iter_plain_text(file_path)
+        
+        extractors = {'.pdf': self._iter_pdf, '.docx': self._iter_docx}
+        if file_ext not in extractors:
+            logger.warning(f"Неподдерживаемый формат: {file_ext}")
+            return iter(())
+        
+        if self.cache_dir:
+            return self._iter_cached(extractors[file_ext], file_path, file_hash)
+        return self._extract_logged(extractors[file_ext], file_path)
+    
+    @staticmethod
+    def _extract_logged(extract, file_path: str) -> Iterator[str]:
+        """
+        Ошибка извлечения пробрасывается: обрезанный текст не должен заменить
+        рабочее поколение, индексация уходит в abort_indexing
+        """
+        try:
+            yield from extract(file_path)
+        except Exception as e:
+            logger.error(f"Ошибка чтения {os.path.splitext(file_path)[1][1:].upper()}: {e}")
+            raise
+    
+    def _cache_path(self, file_hash: str):
+        from pathlib import Path
+        return Path(self.cache_dir) / file_hash[:2] / f"{file_hash}.v{self.EXTRACTOR_VERSION}.txt.z"
+    
+    def remove_cached(self, file_hash: str) -> int:
+        """Удаляет кэшированный текст файла (все версии извлечения)"""
+        from pathlib import Path
+        
+        if not self.cache_dir or not file_hash:
+            return 0
+        
+        removed = 0
+        for path in (Path(self.cache_dir) / file_hash[:2]).glob(f"{file_hash}.v*.txt.z"):
+            try:
+                path.unlink()
+                removed += 1
+            except OSError as e:
+                logger.warning(f"Не удалось удалить кэш текста {path.name}: {e}")
+        return removed
+    
+    def prune_cache(self, max_bytes: int, max_age: int) -> Tuple[int, int]:
+        """
+        Вытесняет записи кэша текста: старше max_age секунд без использования,
+        затем самые давние, пока общий размер больше max_bytes.
+        Возвращает (удалено файлов, осталось байт).
+        """
+        from pathlib import Path
+        
+        if not self.cache_dir or not os.path.isdir(self.cache_dir):
+            return 0, 0
+        
+        entries = []
+        for path in Path(self.cache_dir).glob('*/*.txt.z'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        
+        total = sum(size for _, size, _ in entries)
+        cutoff = time.time() - max_age
+        removed = 0
+        for mtime, size, path in entries:
+            if mtime >= cutoff and total <= max_bytes:
+                break
             try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                logger.info(f"TXT файл прочитан с кодировкой utf-8: {file_path}")
-                return content
-            except UnicodeDecodeError:
-                with open(file_path, 'r', encoding='latin-1') as f:
-                    content = f.read()
-                logger.info(f"TXT файл прочитан с кодировкой latin-1: {file_path}")
-                return content
-        
-        elif file_ext == '.pdf':
+                path.unlink()
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        
+        return removed, total
+    
+    def _iter_cached(self, extract, file_path: str, file_hash: str = None) -> Iterator[str]:
+        """
+        Текст из кэша (zlib), а при промахе — извлечение с одновременной записью в кэш.
+        Файл кэша появляется только после полного успешного извлечения.
+        """
+        path = self._cache_path(file_hash or hash_file(file_path))
+        if path.exists():
+            logger.info(f"Текст из кэша: {path.name}")
             try:
-                from pypdf import PdfReader
-                logger.info(f"Чтение PDF: {file_path}")
-                reader = PdfReader(file_path)
-                text = ""
-                for page in reader.pages:
-                    text += page.extract_text() + "\n"
-                logger.info(f"PDF прочитан: {len(reader.pages)} страниц")
-                return text
-            except Exception as e:
-                logger.error(f"Ошибка чтения PDF: {e}")
-                return ""
-        
-        elif file_ext == '.docx':
+                # mtime — время последнего использования: по нему prune_cache вытесняет старые записи
+                os.utime(path)
+            except OSError:
+                pass
+            yield from self._read_cache(path)
+            return
+        
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+        except OSError as e:
+            logger.warning(f"Кэш текста недоступен ({e}), читаем без него")
+            yield from self._extract_logged(extract, file_path)
+            return
+        
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        compressor = zlib.compressobj(6)
+        try:
+            cache_file = open(tmp_path, 'wb')
+        except OSError as e:
+            logger.warning(f"Кэш текста недоступен ({e}), читаем без него")
+            cache_file = None
+        
+        try:
+            # Ошибки извлечения прерывают поток, ошибки записи кэша — только отключают кэш
+            for piece in self._extract_logged(extract, file_path):
+                if cache_file is not None:
+                    try:
+                        cache_file.write(compressor.compress((piece + "\n").encode('utf-8', 'surrogatepass')))
+                    except OSError as e:
+                        logger.warning(f"Запись кэша текста прервана ({e}), продолжаем без него")
+                        cache_file.close()
+                        cache_file = None
+                yield piece
+            
+            if cache_file is not None:
+                try:
+                    cache_file.write(compressor.flush())
+                    cache_file.close()
+                    cache_file = None
+                    os.replace(tmp_path, path)
+                except OSError as e:
+                    logger.warning(f"Не удалось сохранить кэш текста: {e}")
+        finally:
+            if cache_file is not None:
+                cache_file.close()
             try:
-                from docx import Document
-                logger.info(f"Чтение DOCX: {file_path}")
-                doc = Document(file_path)
-                text = "\n".join([para.text for para in doc.paragraphs])
-                logger.info(f"DOCX прочитан: {len(doc.paragraphs)} параграфов")
-                return text
-            except Exception as e:
-                logger.error(f"Ошибка чтения DOCX: {e}")
-                return ""
+                if tmp_path.exists():
+                    tmp_path.unlink()
+            except OSError:
+                pass
+    
+    @staticmethod
+    def _read_cache(path) -> Iterator[str]:
+        """Потоковая распаковка: отдает текст по строкам"""
+        decompressor = zlib.decompressobj()
+        tail = b''
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                lines = (tail + decompressor.decompress(block)).split(b"\n")
+                tail = lines.pop()
+                for line in lines:
+                    yield line.decode('utf-8', 'surrogatepass')
+        tail += decompressor.flush()
+        if tail:
+            yield tail.decode('utf-8', 'surrogatepass')
+    
+    def _iter_plain_text(self, file_path: str) -> Iterator[str]:
+        logger.info(f"Чтение файла: {file_path}")
+        encoding = self._detect_encoding(file_path)
+        with open(file_path, 'r', encoding=encoding) as f:
+            for line in f:
+                yield line.rstrip('\n')
+        logger.info(f"TXT файл прочитан с кодировкой {encoding}: {file_path}")
+    
+    @staticmethod
+    def _detect_encoding(file_path: str) -> str:
+        """Проверяет UTF-8 инкрементальным декодером, не загружая файл целиком"""
+        import codecs
+        
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        try:
+            with open(file_path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    decoder.decode(block)
+                decoder.decode(b'', final=True)
+            return 'utf-8'
+        except UnicodeDecodeError:
+            return 'latin-1'
+    
+    def _iter_pdf(self, file_path: str) -> Iterator[str]:
+        from pypdf import PdfReader
+        logger.info(f"Чтение PDF: {file_path}")
+        reader = PdfReader(file_path)
+        total_pages = len(reader.pages)
         
+        if self.pdf_workers > 1 and total_pages > self.pdf_pages_per_task and self._can_spawn_workers():
+            yield from self._iter_pdf_parallel(file_path, total_pages)
         else:
-            logger.warning(f"Неподдерживаемый формат: {file_ext}")
-            return ""
+            for page in reader.pages:
+                yield page.extract_text() or ""
+        
+        logger.info(f"PDF прочитан: {total_pages} страниц")
+    
+    _daemon_warned = False
+    
+    @classmethod
+    def _can_spawn_workers(cls) -> bool:
+        """
+        Дочерние процессы prefork-пула Celery демонические и не могут создавать свой пул:
+        параллельное извлечение работает только в воркере с --pool threads или solo
+        """
+        import multiprocessing
+        
+        if not multiprocessing.current_process().daemon:
+            return True
+        if not cls._daemon_warned:
+            cls._daemon_warned = True
+            logger.warning(
+                "RAG_PDF_WORKERS > 1 не действует в демоническом процессе (prefork-пул Celery): "
+                "запустите воркер индексации с --pool threads или --pool solo"
+            )
+        return False
+    
+    def _iter_pdf_parallel(self, file_path: str, total_pages: int) -> Iterator[str]:
+        """
+        Делит PDF на диапазоны страниц, извлекает их в пуле процессов и отдает
+        текст строго по порядку. В работе держится не больше 2 * pdf_workers диапазонов.
+        """
+        from pypdf import PdfReader
+        
+        step = self.pdf_pages_per_task
+        ranges = iter([(start, min(start + step, total_pages)) for start in range(0, total_pages, step)])
+        next_page = 0
+        
+        logger.info(f"Параллельное извлечение PDF: {total_pages} страниц, {self.pdf_workers} процессов")
+        try:
+            # Не fork: воркер с --pool threads многопоточен, и копия чужих захваченных
+            # блокировок в дочернем процессе может его повесить
+            import multiprocessing
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            with ProcessPoolExecutor(
+                max_workers=self.pdf_workers, mp_context=multiprocessing.get_context(start_method)
+            ) as pool:
+                in_flight = deque()
+                for start, end in ranges:
+                    in_flight.append((end, pool.submit(_extract_pdf_pages, file_path, start, end)))
+                    if len(in_flight) >= self.pdf_workers * 2:
+                        break
+                
+                while in_flight:
+                    end, future = in_flight.popleft()
+                    pages = future.result()
+                    
+                    next_range = next(ranges, None)
+                    if next_range:
+                        in_flight.append((next_range[1], pool.submit(_extract_pdf_pages, file_path, *next_range)))
+                    
+                    yield from pages
+                    next_page = end
+        except (BrokenProcessPool, AssertionError, OSError) as e:
+            # Например, внутри демонических процессов пул создать нельзя
+            logger.warning(f"Пул процессов недоступен ({e}), продолжаем последовательно со страницы {next_page}")
+            reader = PdfReader(file_path)
+            for i in range(next_page, total_pages):
+                yield reader.pages[i].extract_text() or ""
+    
+    def _iter_docx(self, file_path: str) -> Iterator[str]:
+        from docx import Document
+        logger.info(f"Чтение DOCX: {file_path}")
+        doc = Document(file_path)
+        for para in doc.paragraphs:
+            yield para.text
+        logger.info(f"DOCX прочитан: {len(doc.paragraphs)} параграфов")
 
 
 class TextChunker:
@@ -99,227 +409,1709 @@ class TextChunker:
     
     def split_text(self, text: str) -> List[str]:
         """Разбивает текст на перекрывающиеся фрагменты"""
-        words = text.split()
-        chunks = []
+        return list(self.split_stream([text]))
+    
+    def split_stream(self, pieces: Iterable[str]) -> Iterator[str]:
+        """
+        Потоковая версия split_text: принимает текст по частям и отдает чанки по мере готовности.
+        В памяти держится только окно из chunk_size слов.
+        """
+        step = self.chunk_size - self.overlap
+        window = []
         
-        for i in range(0, len(words), self.chunk_size - self.overlap):
-            chunk = " ".join(words[i:i + self.chunk_size])
-            if chunk.strip():
-                chunks.append(chunk)
+        for piece in pieces:
+            window.extend(piece.split())
+            while len(window) >= self.chunk_size:
+                yield " ".join(window[:self.chunk_size])
+                del window[:step]
         
-        return chunks
+        while window:
+            yield " ".join(window)
+            del window[:step]
 
 
-class OpenAIEmbedder:
-    """Генерирует embeddings через OpenAI"""
+class ContextPacker:
+    """
+    Собирает контекст для промпта из найденных фрагментов: в пределах бюджета токенов,
+    отбрасывая слабо похожие и повторяющиеся куски соседних (перекрывающихся) чанков
+    """
+    
+    def __init__(self, token_budget: int, min_similarity: float, overlap: int):
+        self.token_budget = token_budget
+        self.min_similarity = min_similarity
+        self.overlap = overlap
     
-    def __init__(self, api_key: str):
-        self.client = OpenAI(api_key=api_key)
-        self.model = "text-embedding-3-small"
+    def pack(self, results: List[Dict]) -> Tuple[List[Dict], int]:
+        """Возвращает (отобранные результаты с укороченными текстами, израсходовано токенов)"""
+        packed = []
+        positions = set()  # (документ, номер чанка) уже взятых фрагментов
+        used = 0
+        
+        for result in results:
+            # Точное совпадение по словам (артикул, телефон) бывает с низкой косинусной близостью
+            if result['similarity'] < self.min_similarity and not result.get('lexical'):
+                continue
+            
+            chunk = result['chunk']
+            position = (chunk.knowledge_base_id, chunk.chunk_index)
+            words = result['text'].split()
+            
+            # Соседние чанки делят overlap слов: начало следующего = конец предыдущего
+            if self.overlap:
+                if (position[0], position[1] - 1) in positions:
+                    words = words[self.overlap:]
+                if (position[0], position[1] + 1) in positions:
+                    words = words[:-self.overlap]
+            if not words:
+                continue
+            
+            text = " ".join(words)
+            tokens = estimate_tokens(text)
+            if used + tokens > self.token_budget:
+                if packed:
+                    continue
+                # Даже самый релевантный фрагмент не влезает — берем его начало
+                text, tokens = self._truncate(words)
+            
+            packed.append(dict(result, text=text))
+            positions.add(position)
+            used += tokens
+        
+        return packed, used
     
-    def get_embedding(self, text: str) -> List[float]:
-        """Получает embedding для текста"""
+    def _truncate(self, words: List[str]) -> Tuple[str, int]:
+        text = " ".join(words)
+        tokens = estimate_tokens(text)
+        while tokens > self.token_budget and len(words) > 1:
+            words = words[:max(1, len(words) * self.token_budget // tokens)]
+            text = " ".join(words)
+            tokens = estimate_tokens(text)
+        return text, tokens
+
+
+class QueryEmbeddingCache:
+    """
+    Двухуровневый кэш эмбеддингов запросов: LRU в памяти процесса перед общим Redis.
+    Векторы хранятся компактно — float32 байтами.
+    """
+    
+    STATS_KEY = 'rag:qemb:stats:{}'
+    STATS_FLUSH_EVERY = 100  # событий между сбросом счетчиков в Redis
+    
+    def __init__(self, max_entries: int, timeout: int):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {'local_hits': 0, 'redis_hits': 0, 'misses': 0}
+        self._pending = dict.fromkeys(self._counters, 0)
+    
+    @staticmethod
+    def make_key(model: str, dimensions: int, text: str) -> str:
+        normalized = " ".join(text.split()).casefold()
+        digest = hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+        return f"rag:qemb:{model}:{dimensions}:{digest}"
+    
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            vector = self._local.get(key)
+            if vector is not None:
+                self._local.move_to_end(key)
+        if vector is not None:
+            self._count('local_hits')
+            return vector
+        
         try:
-            response = self.client.embeddings.create(
-                model=self.model,
-                input=text
-            )
-            return response.data[0].embedding
+            raw = cache.get(key)
         except Exception as e:
-            logger.error(f"Ошибка получения embedding: {e}")
-            return [0.0] * 1536
+            logger.warning(f"Redis недоступен для кэша эмбеддингов: {e}")
+            raw = None
+        
+        if raw is None:
+            self._count('misses')
+            return None
+        
+        vector = np.frombuffer(raw, dtype=np.float32)
+        self._put_local(key, vector)
+        self._count('redis_hits')
+        return vector
+    
+    def set(self, key: str, embedding: List[float]):
+        vector = np.asarray(embedding, dtype=np.float32)
+        self._put_local(key, vector)
+        try:
+            cache.set(key, vector.tobytes(), self.timeout)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить эмбеддинг в Redis: {e}")
+    
+    def get_stats(self) -> Dict:
+        """Счетчики процесса и суммарные по всем процессам (из Redis)"""
+        self._flush()
+        with self._lock:
+            local = dict(self._counters)
+            local['local_entries'] = len(self._local)
+        
+        try:
+            shared = {name: cache.get(self.STATS_KEY.format(name), 0) for name in self._counters}
+        except Exception:
+            shared = {}
+        
+        for stats in (local, shared):
+            lookups = sum(stats.get(name, 0) for name in self._counters)
+            hits = stats.get('local_hits', 0) + stats.get('redis_hits', 0)
+            stats['hit_rate'] = round(hits / lookups, 4) if lookups else 0.0
+        
+        return {'process': local, 'total': shared}
+    
+    def _put_local(self, key: str, vector: np.ndarray):
+        with self._lock:
+            self._local[key] = vector
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_entries:
+                self._local.popitem(last=False)
+    
+    def _count(self, name: str):
+        with self._lock:
+            self._counters[name] += 1
+            self._pending[name] += 1
+            due = sum(self._pending.values()) >= self.STATS_FLUSH_EVERY
+        if due:
+            self._flush()
+    
+    def _flush(self):
+        with self._lock:
+            pending = {name: n for name, n in self._pending.items() if n}
+            self._pending = dict.fromkeys(self._counters, 0)
+        try:
+            for name, n in pending.items():
+                key = self.STATS_KEY.format(name)
+                cache.add(key, 0, timeout=None)
+                cache.incr(key, n)
+        except Exception as e:
+            logger.warning(f"Не удалось обновить счетчики кэша эмбеддингов: {e}")
 
 
-class RAGService:
-    """Главный сервис для работы с RAG"""
+query_embedding_cache = QueryEmbeddingCache(
+    max_entries=getattr(settings, 'RAG_QUERY_EMBEDDING_CACHE_SIZE', 10000),
+    timeout=getattr(settings, 'RAG_QUERY_EMBEDDING_CACHE_TIMEOUT', 7 * 24 * 3600),
+)
+
+
+class OpenAIEmbedder:
+    """Генерирует embeddings через OpenAI"""
     
     def __init__(self):
-        self.file_reader = FileReader()
-        self.text_chunker = TextChunker(chunk_size=500, overlap=50)
-        self.embedder = OpenAIEmbedder(api_key=settings.OPENAI_API_KEY)
+        self.model = getattr(settings, 'RAG_EMBEDDING_MODEL', 'text-embedding-3-small')
+        self.dimensions = getattr(settings, 'RAG_EMBEDDING_DIMENSIONS', 1536)
+        self.batch_size = getattr(settings, 'RAG_EMBEDDING_BATCH_SIZE', 256)
+        self.batch_tokens = getattr(settings, 'RAG_EMBEDDING_BATCH_TOKENS', 200000)
+        self.concurrency = getattr(settings, 'RAG_EMBEDDING_CONCURRENCY', 4)
+        self.max_retries = getattr(settings, 'RAG_EMBEDDING_MAX_RETRIES', 3)
     
-    def process_document(self, knowledge_base_id: int, file_path: str) -> int:
-        """Обрабатывает документ: читает, разбивает, векторизует"""
-        from core.models import KnowledgeBase, KnowledgeChunk
-        from django.utils import timezone
+    @property
+    def client(self) -> OpenAI:
+        # Общий клиент процесса создается при первом запросе, а не при импорте
+        return get_openai_client('embeddings')
+    
+    @property
+    def async_client(self) -> AsyncOpenAI:
+        return get_async_openai_client('embeddings')
+    
+    def _request_params(self, texts) -> Dict:
+        params = {'model': self.model, 'input': texts}
+        # Модели text-embedding-3 умеют отдавать укороченные векторы
+        if self.model.startswith('text-embedding-3'):
+            params['dimensions'] = self.dimensions
+        return params
+    
+    def get_embedding(self, text: str) -> List[float]:
+        """Получает embedding для запроса (через кэш)"""
+        cache_key = QueryEmbeddingCache.make_key(self.model, self.dimensions, text)
+        cached = query_embedding_cache.get(cache_key)
+        if cached is not None:
+            return cached.tolist()
         
         try:
-            kb = KnowledgeBase.objects.get(id=knowledge_base_id)
-            
-            logger.info(f"Чтение файла: {file_path}")
-            text = self.file_reader.read_file(file_path)
-            
-            logger.info("Разбиение на чанки...")
-            chunks = self.text_chunker.split_text(text)
-            
-            KnowledgeChunk.objects.filter(knowledge_base=kb).delete()
-            
-            logger.info(f"Векторизация {len(chunks)} чанков...")
-            for idx, chunk_text in enumerate(chunks):
-                embedding = self.embedder.get_embedding(chunk_text)
-                
-                KnowledgeChunk.objects.create(
-                    knowledge_base=kb,
-                    text=chunk_text,
-                    embedding=embedding,
-                    chunk_index=idx
-                )
-                
-                if (idx + 1) % 10 == 0:
-                    logger.info(f"Обработано {idx + 1}/{len(chunks)} чанков")
-            
-            kb.is_indexed = True
-            kb.chunks_count = len(chunks)
-            kb.indexed_at = timezone.now()
-            kb.save()
-            
-            logger.info(f"Документ успешно обработан, создано {len(chunks)} чанков")
-            return len(chunks)
-            
+            response = self.client.embeddings.create(**self._request_params(text))
+            embedding = response.data[0].embedding
         except Exception as e:
-            logger.error(f"Ошибка обработки документа: {str(e)}")
-            try:
-                kb = KnowledgeBase.objects.get(id=knowledge_base_id)
-                kb.is_indexed = False
-                kb.save()
-            except:
-                pass
-            raise
+            logger.error(f"Ошибка получения embedding: {e}")
+            return [0.0] * self.dimensions
+        
+        query_embedding_cache.set(cache_key, embedding)
+        return embedding
     
-    def search_similar_chunks(self, bot_id: int, query: str, top_k: int = 5) -> List[Dict]:
-        """Ищет похожие чанки для бота"""
-        from core.models import KnowledgeChunk
+    async def aget_embedding(self, text: str) -> List[float]:
+        """Асинхронный get_embedding для запросов (через тот же кэш)"""
+        # Обращения к Redis синхронные — выполняем их в пуле потоков, не блокируя цикл событий
+        cache_key = QueryEmbeddingCache.make_key(self.model, self.dimensions, text)
+        cached = await sync_to_async(query_embedding_cache.get, thread_sensitive=False)(cache_key)
+        if cached is not None:
+            return cached.tolist()
         
         try:
-            logger.info(f"Поиск в базе знаний для бота {bot_id}: {query[:50]}...")
-            
-            query_embedding = self.embedder.get_embedding(query)
-            query_vector = np.array(query_embedding)
-            
-            chunks = KnowledgeChunk.objects.filter(
-                knowledge_base__bots__id=bot_id
-            ).select_related('knowledge_base')
-            
-            if not chunks.exists():
-                logger.warning(f"Нет чанков для бота {bot_id}")
-                return []
-            
-            similarities = []
-            for chunk in chunks:
-                chunk_vector = np.array(chunk.embedding)
-                
-                similarity = np.dot(query_vector, chunk_vector) / (
-                    np.linalg.norm(query_vector) * np.linalg.norm(chunk_vector)
-                )
-                
-                similarities.append({
-                    'chunk': chunk,
-                    'similarity': float(similarity),
-                    'text': chunk.text,
-                    'source': chunk.knowledge_base.title
-                })
-            
-            similarities.sort(key=lambda x: x['similarity'], reverse=True)
-            top_results = similarities[:top_k]
-            
-            logger.info(f"Найдено {len(top_results)} релевантных чанков (лучший: {top_results[0]['similarity']:.2f})")
-            
-            return top_results
-            
+            response = await self.async_client.embeddings.create(**self._request_params(text))
+            embedding = response.data[0].embedding
         except Exception as e:
-            logger.error(f"Ошибка поиска в базе знаний: {e}")
-            return []
+            logger.error(f"Ошибка получения embedding: {e}")
+            return [0.0] * self.dimensions
+        
+        await sync_to_async(query_embedding_cache.set, thread_sensitive=False)(cache_key, embedding)
+        return embedding
     
-    def answer_question(self, bot_id: int, query: str, top_k: int = 5, history: List[Dict] = None) -> Dict:
+    def get_query_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """Векторы пачки запросов: из кэша, недостающие — одним батчевым запросом"""
+        keys = [QueryEmbeddingCache.make_key(self.model, self.dimensions, text) for text in texts]
+        embeddings = [query_embedding_cache.get(key) for key in keys]
+        
+        missing = {}
+        for key, text, embedding in zip(keys, texts, embeddings):
+            if embedding is None:
+                missing.setdefault(key, text)
+        
+        if missing:
+            fetched = dict(zip(missing, self.get_embeddings(list(missing.values()))))
+            for key, embedding in fetched.items():
+                query_embedding_cache.set(key, embedding)
+            embeddings = [
+                fetched[key] if embedding is None else embedding
+                for key, embedding in zip(keys, embeddings)
+            ]
+        
+        return [list(embedding) for embedding in embeddings]
+    
+    def get_embeddings(self, texts: List[str]) -> List[List[float]]:
         """
-        ОБНОВЛЕНО: Поддержка НОВОГО API для o1/o3/GPT-5+
+        Пакетная векторизация: тексты режутся на батчи по лимитам размера и токенов,
+        батчи отправляются параллельно, при ошибке повторяются только упавшие батчи.
         """
-        from core.models import BotAgent
+        if not texts:
+            return []
         
-        try:
-            bot = BotAgent.objects.get(id=bot_id)
-            
-            # ========== ШАГ 1: HUMANIZER ==========
-            humanizer = HUMANIZER_INSTRUCTIONS_TEMPLATE.format(
-                bot_name=bot.name,
-                company_name=bot.company_name or "TheCloser"
-            )
-            
-            # ========== ШАГ 2: USER PROMPT ==========
-            user_prompt = bot.system_prompt or ""
-            
-            # ========== ШАГ 3: RAG CONTEXT ==========
-            context = ""
-            sources = []
-            avg_confidence = 0.0
+        results = [None] * len(texts)
+        pending = self._make_batches(texts)
+        total_batches = len(pending)
+        
+        for attempt in range(self.max_retries + 1):
+            failed = []
+            with ThreadPoolExecutor(max_workers=min(self.concurrency, len(pending))) as pool:
+                futures = {
+                    pool.submit(self._embed_batch, texts[start:end]): (start, end)
+                    for start, end in pending
+                }
+                for future in as_completed(futures):
+                    start, end = futures[future]
+                    try:
+                        results[start:end] = future.result()
+                    except Exception as e:
+                        logger.warning(f"Ошибка векторизации батча [{start}:{end}]: {e}")
+                        failed.append((start, end))
             
-            if bot.use_rag and top_k > 0:
-                results = self.search_similar_chunks(bot_id, query, top_k)
-                
-                if results:
-                    context = "\n\n".join([r['text'] for r in results])
-                    sources = list(set([r['source'] for r in results]))
-                    avg_confidence = sum(r['similarity'] for r in results) / len(results)
+            done = total_batches - len(failed)
+            logger.info(f"Векторизовано батчей: {done}/{total_batches}")
             
-            # ========== ШАГ 4: СБОРКА ФИНАЛЬНОГО ПРОМПТА ==========
-            final_system_prompt = humanizer + "\n\n" + user_prompt
+            if not failed:
+                return results
             
-            if context:
-                final_system_prompt += f"""
+            pending = failed
+            if attempt < self.max_retries:
+                time.sleep(2 ** attempt)
+        
+        raise RuntimeError(f"Не удалось векторизовать {len(pending)} батчей после {self.max_retries} повторов")
+    
+    def _make_batches(self, texts: List[str]) -> List[Tuple[int, int]]:
+        """Границы батчей [start, end) с учетом лимита текстов и оценки токенов"""
+        batches = []
+        start = 0
+        tokens = 0
+        for idx, text in enumerate(texts):
+            text_tokens = estimate_tokens(text)
+            if idx > start and (idx - start >= self.batch_size or tokens + text_tokens > self.batch_tokens):
+                batches.append((start, idx))
+                start = idx
+                tokens = 0
+            tokens += text_tokens
+        batches.append((start, len(texts)))
+        return batches
+    
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        response = self.client.embeddings.create(**self._request_params(texts))
+        data = sorted(response.data, key=lambda item: item.index)
+        return [item.embedding for item in data]
 
-ВАЖНО: Используй следующую информацию из базы знаний для ответа (если она релевантна):
 
-{context}
+class EmbeddingMatrixCache:
+    """
+    LRU-кэш векторов для точного поиска: на каждого бота хранится
+    непрерывная нормированная float32-матрица и параллельный массив id чанков.
+    """
+    
+    def __init__(self, max_bytes: int, ttl: int):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # bot_id -> {'ids', 'matrix', 'kb_ids', 'version', 'loaded_at'}
+        self._size = 0
+        self._lock = threading.Lock()
+    
+    def get(self, bot_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Возвращает (ids, matrix) бота, при необходимости загружая из БД.
+        Запись действительна, пока не изменилась версия знаний бота: переиндексация
+        в другом процессе (Celery) сбрасывает матрицы во всех процессах.
+        """
+        # Версия читается до загрузки: изменение во время загрузки вызовет перезагрузку
+        version = knowledge_version(bot_id)
+        with self._lock:
+            entry = self._entries.get(bot_id)
+            if entry and entry['version'] == version and time.monotonic() - entry['loaded_at'] < self.ttl:
+                self._entries.move_to_end(bot_id)
+                return entry['ids'], entry['matrix']
+        
+        ids, matrix, kb_ids = self._load(bot_id)
+        entry = {'ids': ids, 'matrix': matrix, 'kb_ids': kb_ids, 'version': version, 'loaded_at': time.monotonic()}
+        entry_size = ids.nbytes + matrix.nbytes
+        
+        if entry_size > self.max_bytes:
+            logger.warning(f"Матрица бота {bot_id} ({entry_size} байт) больше бюджета кэша, не кэшируем")
+            return ids, matrix
+        
+        with self._lock:
+            self._pop(bot_id)
+            self._entries[bot_id] = entry
+            self._size += entry_size
+            while self._size > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+        
+        return ids, matrix
+    
+    def invalidate(self, bot_ids: Iterable[int] = (), kb_ids: Iterable[int] = ()):
+        """Сбрасывает записи ботов и записи, в которые входят указанные документы"""
+        kb_ids = set(kb_ids)
+        with self._lock:
+            stale = set(bot_ids) & set(self._entries)
+            if kb_ids:
+                stale.update(
+                    bot_id for bot_id, entry in self._entries.items()
+                    if entry['kb_ids'] & kb_ids
+                )
+            for bot_id in stale:
+                self._pop(bot_id)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+    
+    def _pop(self, bot_id: int):
+        entry = self._entries.pop(bot_id, None)
+        if entry:
+            self._size -= entry['ids'].nbytes + entry['matrix'].nbytes
+    
+    @staticmethod
+    def _load(bot_id: int):
+        from core.models import KnowledgeBase, KnowledgeChunk
+        
+        kb_ids = set(KnowledgeBase.objects.filter(bots__id=bot_id).values_list('id', flat=True))
+        
+        ids = []
+        vectors = []
+        normalized = []
+        rows = KnowledgeChunk.objects.active().filter(
+            knowledge_base_id__in=kb_ids
+        ).values_list('id', 'embedding', 'is_normalized').iterator(chunk_size=2000)
+        for chunk_id, embedding, is_normalized in rows:
+            ids.append(chunk_id)
+            vectors.append(np.asarray(embedding, dtype=np.float32))
+            normalized.append(is_normalized)
+        
+        if not vectors:
+            return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32), kb_ids
+        
+        matrix = np.vstack(vectors)
+        
+        # Векторы нормируются при записи; считаем нормы только для старых строк
+        legacy = ~np.asarray(normalized, dtype=bool)
+        if legacy.any():
+            norms = np.linalg.norm(matrix[legacy], axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            matrix[legacy] /= norms
+        
+        return np.asarray(ids, dtype=np.int64), np.ascontiguousarray(matrix), kb_ids
 
-Отвечай естественно, как живой человек. Если в базе знаний нет информации, используй свои знания, но отдавай приоритет базе знаний."""
-            
-            # ========== ШАГ 5: ФОРМИРУЕМ СООБЩЕНИЯ ==========
-            messages = [{"role": "system", "content": final_system_prompt}]
-            
-            if history:
-                for msg in history:
-                    role = msg.get('role', 'user')
-                    if role not in ['user', 'assistant', 'system']:
-                        role = 'user'
-                    messages.append({"role": role, "content": msg.get('content', '')})
-            
-            messages.append({"role": "user", "content": query})
 
-            # ========== ШАГ 6: ОПРЕДЕЛЯЕМ ТИП API ==========
-            uses_new_api = bot.uses_new_api()
-            
-            logger.info(f"Bot: {bot.name} | Model: {bot.openai_model} | New API: {uses_new_api} | Temp: {bot.temperature} | Max: {bot.max_tokens}")
-            
-            if uses_new_api:
-                logger.info("Using NEW API with max_completion_tokens")
-                response = self.embedder.client.chat.completions.create(
-                    model=bot.openai_model,
-                    messages=messages,
-                )
-            else:
-                logger.info("Using LEGACY API with temperature + max_tokens")
-                response = self.embedder.client.chat.completions.create(
-                    model=bot.openai_model,
-                    messages=messages,
-                    temperature=bot.temperature,
-                    max_tokens=bot.max_tokens
-                )
-            
-            answer = response.choices[0].message.content.strip()
-            
-            return {
-                'answer': answer,
-                'sources': sources,
-                'confidence': avg_confidence
-            }
-            
+embedding_matrix_cache = EmbeddingMatrixCache(
+    max_bytes=getattr(settings, 'RAG_MATRIX_CACHE_MAX_BYTES', 256 * 1024 * 1024),
+    ttl=getattr(settings, 'RAG_MATRIX_CACHE_TTL', 300),
+)
+
+
+KNOWLEDGE_VERSION_KEY = 'rag:kv:{}'
+
+
+def knowledge_version(bot_id: int) -> int:
+    """Версия знаний бота: растет при каждом изменении его документов"""
+    try:
+        return cache.get(KNOWLEDGE_VERSION_KEY.format(bot_id), 0)
+    except Exception as e:
+        logger.warning(f"Redis недоступен для версии знаний: {e}")
+        return 0
+
+
+def _bump_knowledge_version(bot_ids: Iterable[int] = (), kb_ids: Iterable[int] = ()):
+    from core.models import KnowledgeBase
+    
+    bot_ids = set(bot_ids)
+    kb_ids = set(kb_ids)
+    if kb_ids:
+        bot_ids.update(
+            KnowledgeBase.bots.through.objects.filter(
+                knowledgebase_id__in=kb_ids
+            ).values_list('botagent_id', flat=True)
+        )
+    
+    try:
+        for bot_id in bot_ids:
+            key = KNOWLEDGE_VERSION_KEY.format(bot_id)
+            cache.add(key, 0, timeout=None)
+            cache.incr(key)
+    except Exception as e:
+        logger.warning(f"Не удалось обновить версию знаний ботов {bot_ids}: {e}")
+
+
+def invalidate_bot_knowledge(bot_ids: Iterable[int] = (), kb_ids: Iterable[int] = ()):
+    """Вызывается при изменении чанков или привязки документов к ботам"""
+    embedding_matrix_cache.invalidate(bot_ids=bot_ids, kb_ids=kb_ids)
+    _bump_knowledge_version(bot_ids=bot_ids, kb_ids=kb_ids)
+
+
+class RetrievalCache:
+    """
+    Кэш результатов поиска: top-k (id чанка, похожесть) по боту, квантованному вектору
+    запроса и версии знаний бота. Повторный вопрос стоит одного GET в Redis.
+    """
+    
+    KEY = 'rag:ret:{}:{}:{}'
+    
+    def __init__(self, timeout: int):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0}
+    
+    def make_key(self, bot: Dict, query: str, query_embedding: List[float], top_k: int) -> Optional[str]:
+        vector = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if not norm:
+            return None
+        
+        digest = hashlib.sha256(np.round(vector / norm * 127).astype(np.int8).tobytes())
+        params = [
+            bot['rag_search_mode'], top_k, bot['rag_ef_search'], bot['rag_ivfflat_probes'],
+            getattr(settings, 'RAG_SEARCH_BACKEND', 'pgvector'),
+            getattr(settings, 'RAG_EMBEDDING_STORAGE', 'vector'),
+        ]
+        if bot['rag_search_mode'] != 'vector':
+            # Гибридные режимы зависят и от слов запроса
+            params.append(" ".join(query.split()).casefold())
+        digest.update(repr(params).encode('utf-8'))
+        
+        return self.KEY.format(bot['id'], knowledge_version(bot['id']), digest.hexdigest())
+    
+    def get(self, key: str) -> Optional[List[Tuple[int, float]]]:
+        try:
+            ranked = cache.get(key)
         except Exception as e:
-            logger.error(f"Ошибка генерации ответа: {e}")
-            return {
-                'answer': "Извините, произошла ошибка. Попробуйте еще раз.",
-                'sources': [],
-                'confidence': 0.0
-            }
+            logger.warning(f"Redis недоступен для кэша поиска: {e}")
+            ranked = None
+        
+        with self._lock:
+            self._counters['hits' if ranked is not None else 'misses'] += 1
+        return ranked
+    
+    def set(self, key: str, ranked: List[Tuple[int, float]]):
+        try:
+            cache.set(key, [(int(entry[0]), float(entry[1]), *entry[2:]) for entry in ranked], self.timeout)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить результат поиска в кэш: {e}")
+    
+    def get_stats(self) -> Dict:
+        """Счетчики текущего процесса"""
+        with self._lock:
+            stats = dict(self._counters)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        return stats
+
+
+retrieval_cache = RetrievalCache(
+    timeout=getattr(settings, 'RAG_CACHE_TIMEOUT', 3600),
+)
+
+
+class SemanticAnswerCache:
+    """
+    Семантический кэш ответов бота: если вопрос близок (по косинусу эмбеддингов)
+    к уже отвеченному, возвращается сохраненный ответ без вызова LLM.
+    Ключ включает хеш настроек бота и версию его знаний, поэтому правка промпта
+    или переиндексация документов делают старые записи недоступными.
+    Векторы хранятся нормированными и квантованными в int8 — одна запись ~1.5 КБ.
+    """
+    
+    KEY = 'rag:ans:{}:{}:{}'
+    STATS_KEY = 'rag:ans:stats:{}:{}'
+    COUNTERS = ('hits', 'misses', 'saved_tokens')
+    CONFIG_FIELDS = (
+        'name', 'company_name', 'system_prompt', 'openai_model', 'temperature',
+        'max_tokens', 'use_rag', 'rag_top_k', 'rag_search_mode',
+    )
+    
+    def __init__(self, max_entries: int, timeout: int):
+        self.max_entries = max_entries
+        self.timeout = timeout
+    
+    def lookup(self, bot, query_vector: np.ndarray, top_k: int) -> Optional[Dict]:
+        """Ближайший сохраненный ответ с похожестью не ниже порога бота"""
+        quantized = self._quantize(query_vector)
+        if quantized is None:
+            return None
+        
+        try:
+            entries = cache.get(self._key(bot, top_k)) or []
+        except Exception as e:
+            logger.warning(f"Redis недоступен для кэша ответов: {e}")
+            return None
+        
+        if entries:
+            matrix = np.frombuffer(b''.join(e['vector'] for e in entries), dtype=np.int8)
+            matrix = matrix.reshape(len(entries), -1).astype(np.float32)
+            scores = matrix @ quantized.astype(np.float32) / (127.0 * 127.0)
+            best = int(np.argmax(scores))
+            
+            if scores[best] >= bot.answer_cache_threshold:
+                entry = entries[best]
+                self._count(bot.id, 'hits')
+                self._count(bot.id, 'saved_tokens', entry['tokens'])
+                logger.info(f"Кэш ответов: попадание для бота {bot.id} (similarity={scores[best]:.3f})")
+                return entry['result']
+        
+        self._count(bot.id, 'misses')
+        return None
+    
+    def store(self, bot, query_vector: np.ndarray, top_k: int, result: Dict, tokens: int):
+        quantized = self._quantize(query_vector)
+        if quantized is None:
+            return
+        
+        key = self._key(bot, top_k)
+        try:
+            entries = cache.get(key) or []
+            entries.append({'vector': quantized.tobytes(), 'result': result, 'tokens': tokens})
+            cache.set(key, entries[-self.max_entries:], self.timeout)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить ответ в кэш: {e}")
+    
+    def get_stats(self, bot_id: int) -> Dict:
+        try:
+            stats = {name: cache.get(self.STATS_KEY.format(bot_id, name), 0) for name in self.COUNTERS}
+        except Exception:
+            stats = dict.fromkeys(self.COUNTERS, 0)
+        
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        return stats
+    
+    def _key(self, bot, top_k: int) -> str:
+        config = [getattr(bot, field) for field in self.CONFIG_FIELDS]
+        config.append(top_k)
+        config.append(HUMANIZER_INSTRUCTIONS_TEMPLATE)
+        digest = hashlib.sha256(repr(config).encode('utf-8')).hexdigest()[:16]
+        return self.KEY.format(bot.id, digest, knowledge_version(bot.id))
+    
+    @staticmethod
+    def _quantize(vector: np.ndarray) -> Optional[np.ndarray]:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if not norm:
+            # Нулевой вектор — ошибка эмбеддинга, такой запрос не кэшируем
+            return None
+        return np.round(vector / norm * 127).astype(np.int8)
+    
+    def _count(self, bot_id: int, name: str, n: int = 1):
+        key = self.STATS_KEY.format(bot_id, name)
+        try:
+            cache.add(key, 0, timeout=None)
+            cache.incr(key, n)
+        except Exception as e:
+            logger.warning(f"Не удалось обновить счетчики кэша ответов: {e}")
+
+
+semantic_answer_cache = SemanticAnswerCache(
+    max_entries=getattr(settings, 'RAG_ANSWER_CACHE_MAX_ENTRIES', 100),
+    timeout=getattr(settings, 'RAG_CACHE_TIMEOUT', 3600),
+)
+
+
+INDEX_PROGRESS_KEY = 'rag:progress:{}'
+
+
+def set_index_progress(kb_id: int, status: str, **fields):
+    """
+    Прогресс индексации документа для дашборда: queued / running / retrying / done / error
+    плюс счетчики чанков. Запись перезаписывается целиком.
+    """
+    try:
+        cache.set(
+            INDEX_PROGRESS_KEY.format(kb_id),
+            {'status': status, 'updated_at': time.time(), **fields},
+            getattr(settings, 'RAG_INDEX_PROGRESS_TIMEOUT', 24 * 3600)
+        )
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить прогресс индексации {kb_id}: {e}")
+
+
+def get_index_progress(kb_id: int) -> Optional[Dict]:
+    try:
+        return cache.get(INDEX_PROGRESS_KEY.format(kb_id))
+    except Exception as e:
+        logger.warning(f"Redis недоступен для прогресса индексации: {e}")
+        return None
+
+
+class RAGService:
+    """Главный сервис для работы с RAG"""
+    
+    # Настройки бота, нужные поиску
+    SEARCH_BOT_FIELDS = ('id', 'rag_ef_search', 'rag_ivfflat_probes', 'rag_search_mode')
+    
+    def __init__(self):
+        self.file_reader = FileReader()
+        self.text_chunker = TextChunker(chunk_size=500, overlap=50)
+        self.context_packer = ContextPacker(
+            token_budget=getattr(settings, 'RAG_CONTEXT_TOKEN_BUDGET', 2000),
+            min_similarity=getattr(settings, 'RAG_CONTEXT_MIN_SIMILARITY', 0.3),
+            overlap=self.text_chunker.overlap,
+        )
+        self.embedder = OpenAIEmbedder()
+    
+    def prepare_document(self, knowledge_base_id: int, file_path: str) -> Dict:
+        """
+        Первый шаг индексации: потоково читает и разбивает документ, новые чанки
+        пачками пишет в новое поколение без векторов (память зависит от размера пачки,
+        а не документа). После каждой пачки сохраняется контрольная точка: прерванная
+        индексация того же файла продолжается с нее.
+        Векторизация идет по диапазонам chunk_index (embed_pending_range), включение
+        поколения — атомарно в finalize_document, поэтому поиск никогда не видит
+        наполовину проиндексированный документ.
+        """
+        from core.models import KnowledgeChunk
+        
+        generation = None
+        try:
+            kb, existing, generation, checkpoint = self._begin_indexing(knowledge_base_id, file_path)
+            chunks_count, written, reused = self._split_and_write(
+                kb, generation, file_path, existing, checkpoint=checkpoint
+            )
+            
+            # Диапазоны строятся по БД: после возобновления векторы нужны и чанкам до контрольной точки
+            pending_indexes = list(KnowledgeChunk.objects.filter(
+                knowledge_base_id=kb.id, generation=generation, embedding__isnull=True
+            ).order_by('chunk_index').values_list('chunk_index', flat=True))
+            
+            range_size = getattr(settings, 'RAG_FANOUT_RANGE_SIZE', 2000)
+            ranges = [
+                (pending_indexes[i], pending_indexes[min(i + range_size, len(pending_indexes)) - 1])
+                for i in range(0, len(pending_indexes), range_size)
+            ]
+            set_index_progress(
+                kb.id, 'running',
+                chunks=chunks_count, embedded=written - len(pending_indexes), pending=written, reused=len(reused)
+            )
+            
+            return {
+                'generation': generation,
+                'chunks_count': chunks_count,
+                'reused': reused,
+                'pending': written,
+                'ranges': ranges,
+            }
+            
+        except Exception as e:
+            self.abort_indexing(knowledge_base_id, generation, e)
+            raise
+    
+    def embed_pending_range(self, knowledge_base_id: int, generation: int, start: int, end: int) -> int:
+        """
+        Векторизует чанки поколения с chunk_index в [start, end], у которых еще нет вектора.
+        Повторный запуск доделывает только недостающее, поэтому диапазон можно ретраить отдельно.
+        """
+        from core.models import KnowledgeChunk
+        
+        rows = list(KnowledgeChunk.objects.filter(
+            knowledge_base_id=knowledge_base_id,
+            generation=generation,
+            chunk_index__gte=start,
+            chunk_index__lte=end,
+            embedding__isnull=True
+        ).values_list('id', 'text', 'content_hash'))
+        
+        if not rows:
+            return 0
+        
+        embeddings = self._get_chunk_embeddings(rows)
+        
+        KnowledgeChunk.objects.bulk_update([
+            KnowledgeChunk(id=chunk_id, embedding=normalize_vector(embedding), is_normalized=True)
+            for (chunk_id, _, _), embedding in zip(rows, embeddings)
+        ], ['embedding', 'is_normalized'], batch_size=500)
+        
+        logger.info(f"Векторизовано {len(rows)} чанков [{start}..{end}] (поколение {generation})")
+        return len(rows)
+    
+    def finalize_document(self, knowledge_base_id: int, generation: int, chunks_count: int,
+                          reused: List[Tuple[int, int]], pending: int) -> bool:
+        """
+        Последний шаг распределенной индексации: атомарно включает поколение.
+        Возвращает False, если поколение уже вытеснено более новой индексацией.
+        """
+        from core.models import KnowledgeChunk
+        
+        chunks = KnowledgeChunk.objects.filter(knowledge_base_id=knowledge_base_id, generation=generation)
+        if chunks.count() != pending:
+            logger.warning(f"Поколение {generation} базы {knowledge_base_id} устарело, включение пропущено")
+            return False
+        
+        if chunks.filter(embedding__isnull=True).exists():
+            raise RuntimeError(f"В поколении {generation} остались фрагменты без векторов")
+        
+        self._activate_generation(knowledge_base_id, generation, chunks_count, reused)
+        set_index_progress(
+            knowledge_base_id, 'done', chunks=chunks_count, embedded=pending, reused=len(reused)
+        )
+        
+        logger.info(f"Документ успешно обработан, создано {chunks_count} чанков")
+        return True
+    
+    def abort_indexing(self, knowledge_base_id: int, generation: Optional[int], error: Exception):
+        """
+        Фиксирует неудачную индексацию. Недописанное поколение остается вместе с контрольной
+        точкой: повтор с тем же файлом продолжит его, с другим — удалит (_start_generation).
+        """
+        from core.models import KnowledgeBase
+        
+        logger.error(f"Ошибка обработки документа: {str(error)}")
+        set_index_progress(knowledge_base_id, 'error', error=str(error), generation=generation)
+        try:
+            KnowledgeBase.objects.filter(id=knowledge_base_id).update(is_indexed=False)
+        except:
+            pass
+    
+    def _begin_indexing(self, knowledge_base_id: int, file_path: str):
+        """
+        Открывает поколение для индексации: продолжает недописанное, если файл не изменился,
+        иначе начинает новое. Возвращает (kb, хеши активного поколения, поколение, контрольная точка).
+        """
+        from core.models import KnowledgeBase
+        
+        kb = KnowledgeBase.objects.get(id=knowledge_base_id)
+        file_hash = hash_file(file_path)
+        
+        # Неизмененные фрагменты активного поколения переиспользуем вместе с векторами
+        existing = defaultdict(list)
+        for chunk_id, content_hash in kb.chunks.filter(
+            generation=kb.active_generation
+        ).exclude(content_hash='').values_list('id', 'content_hash'):
+            existing[content_hash].append(chunk_id)
+        
+        resume = (
+            getattr(settings, 'RAG_INDEX_RESUME', True)
+            and kb.index_generation is not None
+            and kb.index_generation != kb.active_generation
+            and kb.file_hash == file_hash
+        )
+        
+        if resume:
+            generation, checkpoint = kb.index_generation, kb.index_checkpoint
+            # Строки за контрольной точкой — остаток пачки, которую не успели зафиксировать
+            kb.chunks.filter(generation=generation, chunk_index__gt=checkpoint).delete()
+            logger.info(f"Продолжение индексации документа {kb.id}: поколение {generation}, чанк {checkpoint + 1}")
+        else:
+            generation, checkpoint = self._start_generation(kb), -1
+            KnowledgeBase.objects.filter(id=kb.id).update(
+                file_hash=file_hash, index_generation=generation, index_checkpoint=checkpoint
+            )
+            kb.file_hash = file_hash
+        
+        set_index_progress(kb.id, 'running', chunks=0, embedded=0, reused=0)
+        return kb, existing, generation, checkpoint
+    
+    def _split_and_write(self, kb, generation: int, file_path: str, existing: Dict[str, List[int]],
+                         checkpoint: int = -1):
+        """
+        Потоково разбивает файл и пишет новые чанки (без векторов) в поколение generation.
+        Новые чанки до checkpoint уже записаны прошлой попыткой и пропускаются.
+        Возвращает (всего чанков, новых в поколении, [(id старого чанка, новый chunk_index)])
+        """
+        from core.models import KnowledgeBase
+        
+        logger.info(f"Чтение и разбиение файла: {file_path}")
+        chunks = self.text_chunker.split_stream(self.file_reader.iter_text(file_path, kb.file_hash or None))
+        
+        flush_size = getattr(settings, 'RAG_INDEX_FLUSH_SIZE', 1024)
+        reused = []  # (id старого чанка, новый chunk_index)
+        pending = []  # (chunk_index, текст, хеш) — ждут записи
+        resumed = 0
+        written = 0
+        chunks_count = 0
+        
+        for idx, chunk_text in enumerate(chunks):
+            chunks_count += 1
+            content_hash = hash_text(chunk_text)
+            if existing.get(content_hash):
+                reused.append((existing[content_hash].pop(), idx))
+                continue
+            
+            if idx <= checkpoint:
+                resumed += 1
+                continue
+            
+            pending.append((idx, chunk_text, content_hash))
+            if len(pending) >= flush_size:
+                written += self._write_pending(kb, generation, pending, written)
+                pending = []
+                set_index_progress(kb.id, 'running', chunks=chunks_count, reused=len(reused))
+        
+        written += self._write_pending(kb, generation, pending, written)
+        
+        if resumed and kb.chunks.filter(generation=generation).count() != resumed + written:
+            # Поколение не совпадает с контрольной точкой — следующая попытка начнет заново
+            KnowledgeBase.objects.filter(id=kb.id).update(index_generation=None, index_checkpoint=-1)
+            raise RuntimeError(f"Поколение {generation} не соответствует контрольной точке {checkpoint}")
+        
+        stale_count = sum(len(ids) for ids in existing.values())
+        logger.info(
+            f"Чанков: {chunks_count} | без изменений: {len(reused)} | "
+            f"новых/измененных: {written} | из прошлой попытки: {resumed} | устаревших: {stale_count}"
+        )
+        return chunks_count, resumed + written, reused
+    
+    def _write_pending(self, kb, generation: int, pending: List[Tuple[int, str, str]], written: int) -> int:
+        """
+        Пишет пачку новых чанков без векторов в поколение generation
+        и в той же транзакции сдвигает контрольную точку
+        """
+        from core.models import KnowledgeBase, KnowledgeChunk
+        from django.db import transaction
+        
+        if not pending:
+            return 0
+        
+        with transaction.atomic():
+            self._write_chunks([
+                KnowledgeChunk(
+                    knowledge_base=kb,
+                    generation=generation,
+                    text=chunk_text,
+                    content_hash=content_hash,
+                    embedding=None,
+                    is_normalized=False,
+                    chunk_index=idx
+                )
+                for idx, chunk_text, content_hash in pending
+            ], use_copy=written + len(pending) >= getattr(settings, 'RAG_COPY_THRESHOLD', 5000))
+            KnowledgeBase.objects.filter(id=kb.id).update(index_checkpoint=pending[-1][0])
+        
+        logger.info(f"Записано {written + len(pending)} новых чанков (поколение {generation})")
+        return len(pending)
+    
+    def _get_chunk_embeddings(self, pending: List[Tuple[int, str, str]]) -> List[List[float]]:
+        """
+        Векторы для пачки чанков: сначала из общего хранилища по хешу текста,
+        в OpenAI уходят только тексты, которых там еще нет (каждый один раз)
+        """
+        from core.models import SharedEmbedding
+        
+        if not getattr(settings, 'RAG_SHARED_EMBEDDINGS', True):
+            return self.embedder.get_embeddings([chunk_text for _, chunk_text, _ in pending])
+        
+        model, dimensions = self.embedder.model, self.embedder.dimensions
+        hashes = {content_hash for _, _, content_hash in pending}
+        
+        known = dict(SharedEmbedding.objects.filter(
+            model=model, dimensions=dimensions, text_hash__in=hashes
+        ).values_list('text_hash', 'embedding'))
+        
+        missing = {}
+        for _, chunk_text, content_hash in pending:
+            if content_hash not in known:
+                missing.setdefault(content_hash, chunk_text)
+        
+        if missing:
+            new_embeddings = self.embedder.get_embeddings(list(missing.values()))
+            known.update(zip(missing.keys(), new_embeddings))
+            SharedEmbedding.objects.bulk_create(
+                [
+                    SharedEmbedding(model=model, dimensions=dimensions, text_hash=content_hash, embedding=embedding)
+                    for content_hash, embedding in zip(missing.keys(), new_embeddings)
+                ],
+                batch_size=getattr(settings, 'RAG_BULK_CREATE_BATCH_SIZE', 1000),
+                ignore_conflicts=True,
+            )
+        
+        logger.info(f"Векторы: {len(pending) - len(missing)} из общего хранилища, {len(missing)} запрошено у OpenAI")
+        return [known[content_hash] for _, _, content_hash in pending]
+    
+    def _start_generation(self, kb) -> int:
+        """Выделяет номер нового поколения и убирает недописанные поколения прошлых попыток"""
+        from core.models import KnowledgeChunk
+        from django.db.models import Max
+        
+        chunks = KnowledgeChunk.objects.filter(knowledge_base=kb)
+        last = chunks.aggregate(last=Max('generation'))['last'] or 0
+        chunks.exclude(generation=kb.active_generation).delete()
+        
+        return max(last, kb.active_generation) + 1
+    
+    def _activate_generation(self, knowledge_base_id: int, generation: int, chunks_count: int,
+                             reused: List[Tuple[int, int]] = ()):
+        """
+        Атомарно переключает документ на новое поколение: переносит в него
+        переиспользуемые чанки (reused — пары id/новый chunk_index) и удаляет остальные старые.
+        """
+        from core.models import KnowledgeBase, KnowledgeChunk
+        from django.db import transaction
+        from django.utils import timezone
+        
+        with transaction.atomic():
+            kb = KnowledgeBase.objects.select_for_update().get(id=knowledge_base_id)
+            
+            KnowledgeChunk.objects.bulk_update(
+                [KnowledgeChunk(id=chunk_id, chunk_index=idx, generation=generation) for chunk_id, idx in reused],
+                ['chunk_index', 'generation'],
+                batch_size=getattr(settings, 'RAG_BULK_CREATE_BATCH_SIZE', 1000)
+            )
+            KnowledgeChunk.objects.filter(knowledge_base=kb).exclude(generation=generation).delete()
+            
+            kb.active_generation = generation
+            kb.is_indexed = True
+            kb.chunks_count = chunks_count
+            kb.indexed_at = timezone.now()
+            kb.index_generation = None
+            kb.index_checkpoint = -1
+            kb.save(update_fields=[
+                'active_generation', 'is_indexed', 'chunks_count', 'indexed_at',
+                'index_generation', 'index_checkpoint', 'updated_at'
+            ])
+    
+    def _write_chunks(self, chunks: List, use_copy: bool = False) -> None:
+        """Пакетная запись чанков: bulk_create, для очень больших документов — COPY"""
+        from core.models import KnowledgeChunk
+        from django.db import connection
+        
+        batch_size = getattr(settings, 'RAG_BULK_CREATE_BATCH_SIZE', 1000)
+        
+        if connection.vendor == 'postgresql' and use_copy:
+            for start in range(0, len(chunks), batch_size):
+                self._copy_chunks(chunks[start:start + batch_size])
+        else:
+            KnowledgeChunk.objects.bulk_create(chunks, batch_size=batch_size)
+    
+    @staticmethod
+    def _copy_chunks(chunks: List) -> None:
+        """Загрузка пачки чанков через COPY ... FROM STDIN (CSV)"""
+        from core.models import KnowledgeChunk
+        from django.db import connection
+        
+        fields = [f for f in KnowledgeChunk._meta.concrete_fields if not f.primary_key]
+        
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for chunk in chunks:
+            row = []
+            for field in fields:
+                value = field.get_db_prep_save(field.pre_save(chunk, True), connection)
+                row.append('\\N' if value is None else value)
+            writer.writerow(row)
+        buffer.seek(0)
+        
+        columns = ', '.join(connection.ops.quote_name(f.column) for f in fields)
+        table = connection.ops.quote_name(KnowledgeChunk._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.copy_expert(
+                f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+                buffer
+            )
+    
+    def search_similar_chunks(self, bot_id: int, query: str, top_k: int = 5, stats: Dict = None) -> List[Dict]:
+        """
+        Ищет похожие чанки для бота.
+        stats (необязательно) заполняется режимом поиска и числом просмотренных кандидатов.
+        """
+        from core.models import BotAgent
+        
+        stats = stats if stats is not None else {}
+        try:
+            logger.info(f"Поиск в базе знаний для бота {bot_id}: {query[:50]}...")
+            
+            bot = BotAgent.objects.filter(id=bot_id).values(*self.SEARCH_BOT_FIELDS).first()
+            if not bot:
+                logger.warning(f"Бот {bot_id} не найден")
+                return []
+            
+            # Векторы чанков хранятся единичными: с единичным запросом косинус = скалярное произведение
+            query_embedding = normalize_vector(self.embedder.get_embedding(query))
+            
+            return self._rank_and_load(bot, query, query_embedding, top_k, stats)
+            
+        except Exception as e:
+            logger.error(f"Ошибка поиска в базе знаний: {e}")
+            return []
+    
+    async def asearch_similar_chunks(self, bot_id: int, query: str, top_k: int = 5,
+                                     stats: Dict = None) -> List[Dict]:
+        """
+        Асинхронный search_similar_chunks: эмбеддинг запроса — через AsyncOpenAI,
+        настройки бота — асинхронным ORM. Ранжирование (сырой SQL с SET LOCAL или numpy)
+        выполняется в пуле потоков, не занимая поток, привязанный к циклу событий.
+        """
+        from core.models import BotAgent
+        
+        stats = stats if stats is not None else {}
+        try:
+            logger.info(f"Поиск в базе знаний для бота {bot_id}: {query[:50]}...")
+            
+            bot = await BotAgent.objects.filter(id=bot_id).values(*self.SEARCH_BOT_FIELDS).afirst()
+            if not bot:
+                logger.warning(f"Бот {bot_id} не найден")
+                return []
+            
+            query_embedding = normalize_vector(await self.embedder.aget_embedding(query))
+            
+            return await sync_to_async(with_db_connection(self._rank_and_load), thread_sensitive=False)(
+                bot, query, query_embedding, top_k, stats
+            )
+            
+        except Exception as e:
+            logger.error(f"Ошибка поиска в базе знаний: {e}")
+            return []
+    
+    def _rank_and_load(self, bot: Dict, query: str, query_embedding: np.ndarray,
+                       top_k: int, stats: Dict) -> List[Dict]:
+        """Ранжирование выбранным режимом (через кэш результатов) и загрузка текстов"""
+        stats['mode'] = bot['rag_search_mode']
+        cache_key = None
+        ranked = None
+        if getattr(settings, 'RAG_RETRIEVAL_CACHE', True):
+            cache_key = retrieval_cache.make_key(bot, query, query_embedding, top_k)
+            ranked = retrieval_cache.get(cache_key) if cache_key else None
+            stats['cached'] = ranked is not None
+        
+        if ranked is None:
+            if bot['rag_search_mode'] == 'hybrid':
+                ranked = self._rank_hybrid_prefilter(bot, query, query_embedding, top_k, stats)
+            elif bot['rag_search_mode'] == 'fusion':
+                ranked = self._rank_hybrid_fusion(bot, query, query_embedding, top_k, stats)
+            else:
+                ranked = self._rank_vector(bot, query_embedding, top_k, stats)
+            
+            if cache_key:
+                retrieval_cache.set(cache_key, ranked)
+        
+        if not ranked:
+            logger.warning(f"Нет чанков для бота {bot['id']}")
+            return []
+        
+        top_results = self._load_results(ranked)
+        
+        if top_results:
+            logger.info(
+                f"Найдено {len(top_results)} релевантных чанков (лучший: {top_results[0]['similarity']:.2f}) | "
+                f"режим: {stats.get('mode')} | кандидатов: {stats.get('candidates', '?')}"
+            )
+        
+        return top_results
+    
+    def _rank_vector(self, bot: Dict, query_embedding: List[float], top_k: int, stats: Dict) -> List[Tuple[int, float]]:
+        """Чисто векторный поиск выбранным бэкендом"""
+        if getattr(settings, 'RAG_SEARCH_BACKEND', 'pgvector') == 'exact':
+            return self._rank_exact(bot['id'], query_embedding, top_k, stats)
+        
+        # Сколько строк просмотрел ANN-индекс, неизвестно — сообщаем размер списка кандидатов
+        stats['candidates'] = max(bot['rag_ef_search'], top_k)
+        results = self._rank_pgvector(bot, query_embedding, top_k)
+        
+        # Фильтр по боту и поколению применяется после обхода HNSW, а индекс отдает не больше
+        # ef_search глобальных соседей: у бота с малой долей чанков их может не хватить.
+        # Досчитываем точно, но в Postgres — векторы бота в процесс не загружаются
+        if len(results) < top_k:
+            logger.info(f"ANN вернул {len(results)} из {top_k} для бота {bot['id']}, точный поиск в БД")
+            stats['fallback'] = 'exact_sql'
+            return self._rank_pgvector(bot, query_embedding, top_k, exact=True)
+        return results
+    
+    def _rank_hybrid_prefilter(self, bot: Dict, query: str, query_embedding: List[float],
+                               top_k: int, stats: Dict) -> List[Tuple]:
+        """
+        Гибридный поиск: полнотекстовый индекс отбирает кандидатов,
+        векторная близость считается только для них.
+        """
+        from django.db import connection
+        
+        tsquery = self._build_tsquery(query)
+        limit = getattr(settings, 'RAG_HYBRID_CANDIDATES', 200)
+        
+        rows = []
+        if tsquery:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"""
+                    WITH candidates AS (
+                        {self._lexical_sql()}
+                    )
+                    SELECT id, embedding {self._distance_operator()} {self._vector_param_sql()} AS distance, COUNT(*) OVER ()
+                    FROM candidates
+                    ORDER BY distance
+                    LIMIT %s
+                    """,
+                    [bot['id'], tsquery, tsquery, limit, self._vector_literal(query_embedding), top_k]
+                )
+                rows = cursor.fetchall()
+        
+        if not rows:
+            # По словам ничего не нашлось — обычный векторный поиск
+            stats['mode'] = 'hybrid:vector-fallback'
+            return self._rank_vector(bot, query_embedding, top_k, stats)
+        
+        stats['candidates'] = rows[0][2]
+        # Третий элемент — фрагмент найден лексическим поиском (ContextPacker не отсекает его по похожести)
+        return [(chunk_id, self._similarity(distance), True) for chunk_id, distance, _ in rows]
+    
+    def _rank_hybrid_fusion(self, bot: Dict, query: str, query_embedding: List[float],
+                            top_k: int, stats: Dict) -> List[Tuple]:
+        """
+        Гибридный поиск: слияние лексического и векторного рангов (Reciprocal Rank Fusion).
+        В ответе — косинусная близость, порядок — по RRF.
+        """
+        from django.db import connection
+        
+        limit = getattr(settings, 'RAG_HYBRID_CANDIDATES', 200)
+        rrf_k = 60
+        
+        lexical_ids = []
+        tsquery = self._build_tsquery(query)
+        if tsquery:
+            with connection.cursor() as cursor:
+                cursor.execute(self._lexical_sql('c.id'), [bot['id'], tsquery, tsquery, limit])
+                lexical_ids = [row[0] for row in cursor.fetchall()]
+        
+        vector_stats = {}
+        vector_ranked = self._rank_vector(bot, query_embedding, limit, vector_stats)
+        stats['candidates'] = len(lexical_ids) + (vector_stats.get('candidates') or 0)
+        
+        scores = defaultdict(float)
+        for rank, chunk_id in enumerate(lexical_ids):
+            scores[chunk_id] += 1.0 / (rrf_k + rank + 1)
+        for rank, (chunk_id, _) in enumerate(vector_ranked):
+            scores[chunk_id] += 1.0 / (rrf_k + rank + 1)
+        
+        top_ids = sorted(scores, key=scores.get, reverse=True)[:top_k]
+        if not top_ids:
+            return []
+        
+        similarity = dict(vector_ranked)
+        missing = [chunk_id for chunk_id in top_ids if chunk_id not in similarity]
+        if missing:
+            from core.models import KnowledgeChunk
+            
+            similarity.update(
+                (chunk_id, self._similarity(distance))
+                for chunk_id, distance in KnowledgeChunk.objects.filter(id__in=missing)
+                .annotate(distance=self._distance('embedding', query_embedding))
+                .values_list('id', 'distance')
+            )
+        
+        lexical = set(lexical_ids)
+        return [(chunk_id, similarity.get(chunk_id, 0.0), chunk_id in lexical) for chunk_id in top_ids]
+    
+    @staticmethod
+    def _bot_chunks_sql() -> str:
+        """FROM/WHERE для активных чанков бота (параметр: bot_id), алиас таблицы — c"""
+        from core.models import KnowledgeBase, KnowledgeChunk
+        
+        chunks_table = KnowledgeChunk._meta.db_table
+        kb_table = KnowledgeBase._meta.db_table
+        bots_table = KnowledgeBase.bots.through._meta.db_table
+        
+        return f"""
+            FROM {chunks_table} c
+            JOIN {kb_table} kb ON kb.id = c.knowledge_base_id AND c.generation = kb.active_generation
+            JOIN {bots_table} kbb ON kbb.knowledgebase_id = c.knowledge_base_id
+            WHERE kbb.botagent_id = %s
+        """
+    
+    def _lexical_sql(self, columns: str = 'c.id, c.embedding') -> str:
+        """
+        Кандидаты по полнотекстовому индексу (параметры: bot_id, tsquery, tsquery, limit).
+        Векторы нужны только префильтру внутри CTE; слиянию рангов хватает id.
+        """
+        return f"""
+            SELECT {columns}
+            {self._bot_chunks_sql()}
+              AND c.search_vector @@ to_tsquery('{RAG_FTS_CONFIG}', %s)
+            ORDER BY ts_rank_cd(c.search_vector, to_tsquery('{RAG_FTS_CONFIG}', %s)) DESC
+            LIMIT %s
+        """
+    
+    @staticmethod
+    def _vector_param_sql() -> str:
+        """Плейсхолдер вектора запроса с приведением к типу колонки embedding"""
+        column_type = 'halfvec' if getattr(settings, 'RAG_EMBEDDING_STORAGE', 'vector') == 'halfvec' else 'vector'
+        return f"%s::{column_type}"
+    
+    @staticmethod
+    def _use_inner_product() -> bool:
+        """RAG_VECTOR_METRIC = 'ip' включается после rag_normalize_embeddings"""
+        return getattr(settings, 'RAG_VECTOR_METRIC', 'cosine') == 'ip'
+    
+    def _distance_operator(self) -> str:
+        return '<#>' if self._use_inner_product() else '<=>'
+    
+    def _distance(self, field: str, query_embedding):
+        from pgvector.django import CosineDistance, MaxInnerProduct
+        
+        if self._use_inner_product():
+            return MaxInnerProduct(field, query_embedding)
+        return CosineDistance(field, query_embedding)
+    
+    def _similarity(self, distance) -> float:
+        """Расстояние pgvector -> косинусная близость (<#> возвращает -(a·b))"""
+        if self._use_inner_product():
+            return -float(distance)
+        return 1.0 - float(distance)
+    
+    @staticmethod
+    def _build_tsquery(query: str) -> str:
+        """Слова запроса через OR: достаточно совпадения любого термина (артикул, телефон, название)"""
+        terms = [term for term in re.split(r'[\W_]+', query.lower()) if term]
+        return " | ".join(dict.fromkeys(terms))
+    
+    @staticmethod
+    def _vector_literal(vector: Iterable[float]) -> str:
+        return '[' + ','.join(str(float(v)) for v in vector) + ']'
+    
+    def _rank_pgvector(self, bot: Dict, query_embedding: List[float], top_k: int,
+                       exact: bool = False) -> List[Tuple[int, float]]:
+        """
+        ANN-поиск в Postgres: ORDER BY расстояние (косинусное или скалярное) LIMIT top_k.
+        exact=True — точный перебор активных чанков бота без векторного индекса.
+        """
+        from core.models import KnowledgeChunk
+        from django.db import connection, transaction
+        
+        binary = getattr(settings, 'RAG_EMBEDDING_STORAGE', 'vector') == 'bit' and not exact
+        rerank_factor = getattr(settings, 'RAG_BINARY_RERANK_FACTOR', 4)
+        candidates = top_k * rerank_factor if binary else top_k
+        
+        # SET LOCAL действует только внутри транзакции
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                if exact:
+                    # HNSW не умеет bitmap-сканирование: план пойдет по индексу knowledge_base_id
+                    cursor.execute("SET LOCAL enable_indexscan = off")
+                else:
+                    cursor.execute("SET LOCAL hnsw.ef_search = %s", [max(bot['rag_ef_search'], candidates)])
+                    cursor.execute("SET LOCAL ivfflat.probes = %s", [bot['rag_ivfflat_probes']])
+                    iterative_scan = getattr(settings, 'RAG_HNSW_ITERATIVE_SCAN', '')
+                    if iterative_scan:
+                        cursor.execute("SET LOCAL hnsw.iterative_scan = %s", [iterative_scan])
+                
+                if binary:
+                    # Грубый отбор по расстоянию Хэмминга в бинарном индексе,
+                    # затем переранжирование кандидатов по полным векторам
+                    dimensions = len(query_embedding)
+                    vector = self._vector_literal(query_embedding)
+                    cursor.execute(
+                        f"""
+                        SELECT id, embedding {self._distance_operator()} %s::vector AS distance
+                        FROM (
+                            SELECT c.id, c.embedding
+                            {self._bot_chunks_sql()}
+                            ORDER BY binary_quantize(c.embedding)::bit({dimensions})
+                                <~> binary_quantize(%s::vector)::bit({dimensions})
+                            LIMIT %s
+                        ) candidates
+                        ORDER BY distance
+                        LIMIT %s
+                        """,
+                        [vector, bot['id'], vector, candidates, top_k]
+                    )
+                    rows = cursor.fetchall()
+                    return [(chunk_id, self._similarity(distance)) for chunk_id, distance in rows]
+            
+            rows = list(
+                KnowledgeChunk.objects.active()
+                .filter(knowledge_base__bots__id=bot['id'])
+                .annotate(distance=self._distance('embedding', query_embedding))
+                .order_by('distance')
+                .values_list('id', 'distance')[:top_k]
+            )
+        
+        return [(chunk_id, self._similarity(distance)) for chunk_id, distance in rows]
+    
+    def _rank_exact(self, bot_id: int, query_embedding: List[float], top_k: int,
+                    stats: Dict = None) -> List[Tuple[int, float]]:
+        """Точный поиск: одно умножение матрицы бота на вектор запроса + argpartition"""
+        ids, matrix = embedding_matrix_cache.get(bot_id)
+        if stats is not None:
+            stats['candidates'] = len(ids)
+        if not len(ids) or top_k <= 0:
+            return []
+        
+        # Запрос уже нормирован в search_similar_chunks, строки матрицы — при записи/загрузке
+        query_vector = np.asarray(query_embedding, dtype=np.float32)
+        if not query_vector.any():
+            return []
+        
+        scores = matrix @ query_vector
+        
+        k = min(top_k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        
+        return [(int(ids[i]), float(scores[i])) for i in top]
+    
+    def search_many(self, bot_id: int, queries: List[str], top_k: int = 5) -> List[List[Dict]]:
+        """
+        Пакетный поиск для оценки качества и прогрева кэшей: все запросы векторизуются
+        одним вызовом и ранжируются одним умножением матриц по матрице бота.
+        Ранжирование — чисто векторное (точное), независимо от режима поиска бота.
+        Возвращает список результатов в порядке queries.
+        """
+        if not queries:
+            return []
+        
+        try:
+            ids, matrix = embedding_matrix_cache.get(bot_id)
+            if not len(ids) or top_k <= 0:
+                return [[] for _ in queries]
+            
+            embeddings = self.embedder.get_query_embeddings(queries)
+            query_matrix = np.vstack([normalize_vector(embedding) for embedding in embeddings])
+            
+            scores = query_matrix @ matrix.T  # (запросы, чанки)
+            
+            k = min(top_k, len(ids))
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            order = np.argsort(-top_scores, axis=1)
+            top = np.take_along_axis(top, order, axis=1)
+            top_scores = np.take_along_axis(top_scores, order, axis=1)
+            
+            ranked_lists = []
+            for query_vector, row, row_scores in zip(query_matrix, top, top_scores):
+                if not query_vector.any():
+                    # Эмбеддинг запроса не получен
+                    ranked_lists.append([])
+                    continue
+                ranked_lists.append([(int(ids[i]), float(score)) for i, score in zip(row, row_scores)])
+            
+            logger.info(f"Пакетный поиск для бота {bot_id}: {len(queries)} запросов x {len(ids)} чанков")
+            return self._load_results_many(ranked_lists)
+            
+        except Exception as e:
+            logger.error(f"Ошибка пакетного поиска: {e}")
+            return [[] for _ in queries]
+    
+    def _load_results(self, ranked: List[Tuple[int, float]]) -> List[Dict]:
+        """Подгружает тексты найденных чанков (без векторов) в порядке ранжирования"""
+        return self._load_results_many([ranked])[0]
+    
+    def _load_results_many(self, ranked_lists: List[List[Tuple[int, float]]]) -> List[List[Dict]]:
+        """То же для нескольких ранжирований — одним запросом к БД"""
+        from core.models import KnowledgeChunk
+        
+        chunks = KnowledgeChunk.objects.filter(
+            id__in={chunk_id for ranked in ranked_lists for chunk_id, *_ in ranked}
+        ).select_related('knowledge_base').defer('embedding')
+        chunks_by_id = {chunk.id: chunk for chunk in chunks}
+        
+        results_lists = []
+        for ranked in ranked_lists:
+            results = []
+            # Элементы ранжирования: (id, похожесть) или (id, похожесть, найден по словам)
+            for chunk_id, similarity, *flags in ranked:
+                chunk = chunks_by_id.get(chunk_id)
+                if chunk is None:
+                    continue
+                results.append({
+                    'chunk': chunk,
+                    'similarity': similarity,
+                    'lexical': bool(flags and flags[0]),
+                    'text': chunk.text,
+                    'source': chunk.knowledge_base.title
+                })
+            results_lists.append(results)
+        return results_lists
+    
+    def answer_question(self, bot_id: int, query: str, top_k: int = 5, history: List[Dict] = None) -> Dict:
+        """
+        ОБНОВЛЕНО: Поддержка НОВОГО API для o1/o3/GPT-5+
+        """
+        from core.models import BotAgent
+        
+        try:
+            bot = BotAgent.objects.get(id=bot_id)
+            
+            # ========== ШАГ 0: СЕМАНТИЧЕСКИЙ КЭШ ОТВЕТОВ ==========
+            query_vector = None
+            use_answer_cache = self._use_answer_cache(bot, query, history)
+            if use_answer_cache:
+                # Тот же эмбеддинг потом возьмет поиск — из кэша эмбеддингов запросов
+                query_vector = np.asarray(self.embedder.get_embedding(query), dtype=np.float32)
+                cached = semantic_answer_cache.lookup(bot, query_vector, top_k)
+                if cached:
+                    return cached
+            
+            # ========== ШАГ 1: RAG CONTEXT ==========
+            results = []
+            if bot.use_rag and top_k > 0:
+                results = self.search_similar_chunks(bot_id, query, top_k)
+            context = self._pack_context(results)
+            
+            # ========== ШАГ 2: ПРОМПТ И ВЫЗОВ МОДЕЛИ ==========
+            messages = self._build_messages(bot, query, history, context['text'])
+            response = get_openai_client('chat').chat.completions.create(**self._completion_params(bot, messages))
+            
+            return self._make_result(
+                bot, response.choices[0].message.content.strip(), getattr(response, 'usage', None),
+                context, top_k, query_vector if use_answer_cache else None
+            )
+            
+        except Exception as e:
+            logger.error(f"Ошибка генерации ответа: {e}")
+            return self._error_result()
+    
+    async def aanswer_question(self, bot_id: int, query: str, top_k: int = 5, history: List[Dict] = None) -> Dict:
+        """
+        Асинхронный answer_question: эмбеддинги и ответ модели — через AsyncOpenAI,
+        поэтому ожидание OpenAI не занимает поток
+        """
+        from core.models import BotAgent
+        
+        try:
+            bot = await BotAgent.objects.aget(id=bot_id)
+            
+            cached, query_vector = await self.alookup_answer(bot, query, top_k, history)
+            if cached:
+                return cached
+            
+            results = []
+            if bot.use_rag and top_k > 0:
+                results = await self.asearch_similar_chunks(bot_id, query, top_k)
+            context = self._pack_context(results)
+            
+            messages = self._build_messages(bot, query, history, context['text'])
+            response = await get_async_openai_client('chat').chat.completions.create(
+                **self._completion_params(bot, messages)
+            )
+            
+            return await self.astore_answer(
+                bot, query_vector, top_k, response.choices[0].message.content.strip(),
+                context, getattr(response, 'usage', None)
+            )
+            
+        except Exception as e:
+            logger.error(f"Ошибка генерации ответа: {e}")
+            return self._error_result()
+    
+    def stream_answer(self, bot_id: int, query: str, top_k: int = 5,
+                      history: List[Dict] = None) -> Iterator[Dict]:
+        """
+        Потоковый answer_question: по мере генерации отдает {'type': 'delta', 'text': ...},
+        последним — {'type': 'done', 'answer', 'sources', 'confidence', 'context_tokens'}
+        """
+        from core.models import BotAgent
+        
+        try:
+            bot = BotAgent.objects.get(id=bot_id)
+            
+            query_vector = None
+            use_answer_cache = self._use_answer_cache(bot, query, history)
+            if use_answer_cache:
+                query_vector = np.asarray(self.embedder.get_embedding(query), dtype=np.float32)
+                cached = semantic_answer_cache.lookup(bot, query_vector, top_k)
+                if cached:
+                    yield {'type': 'delta', 'text': cached['answer']}
+                    yield {'type': 'done', **cached}
+                    return
+            
+            results = []
+            if bot.use_rag and top_k > 0:
+                results = self.search_similar_chunks(bot_id, query, top_k)
+            context = self._pack_context(results)
+            
+            messages = self._build_messages(bot, query, history, context['text'])
+            stream = get_openai_client('chat').chat.completions.create(
+                **self._completion_params(bot, messages),
+                stream=True,
+                stream_options={'include_usage': True},
+            )
+            
+            parts = []
+            usage = None
+            for chunk in stream:
+                if chunk.usage:
+                    usage = chunk.usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                    yield {'type': 'delta', 'text': parts[-1]}
+            
+            result = self._make_result(
+                bot, "".join(parts).strip(), usage,
+                context, top_k, query_vector if use_answer_cache else None
+            )
+            yield {'type': 'done', **result}
+            
+        except Exception as e:
+            logger.error(f"Ошибка генерации ответа: {e}")
+            yield {'type': 'done', **self._error_result()}
+    
+    def retrieve_context(self, bot_id: int, query: str, top_k: int = 5) -> Dict:
+        """
+        Только поиск без генерации: готовый контекст для промпта вызывающей стороны
+        {'text', 'sources', 'confidence', 'tokens'}
+        """
+        return self._pack_context(self.search_similar_chunks(bot_id, query, top_k))
+    
+    async def aretrieve_context(self, bot_id: int, query: str, top_k: int = 5) -> Dict:
+        """Асинхронный retrieve_context"""
+        return self._pack_context(await self.asearch_similar_chunks(bot_id, query, top_k))
+    
+    async def alookup_answer(self, bot, query: str, top_k: int, history: List[Dict] = None):
+        """
+        Семантический кэш ответов, в том числе для ответов, собранных вне answer_question
+        (Telegram-воркер). Возвращает (результат из кэша или None, вектор запроса для astore_answer).
+        """
+        if not self._use_answer_cache(bot, query, history):
+            return None, None
+        
+        query_vector = np.asarray(await self.embedder.aget_embedding(query), dtype=np.float32)
+        # Кэш ответов и версия знаний читаются из Redis синхронно — вне цикла событий
+        cached = await sync_to_async(semantic_answer_cache.lookup, thread_sensitive=False)(
+            bot, query_vector, top_k
+        )
+        return cached, query_vector
+    
+    async def astore_answer(self, bot, query_vector: Optional[np.ndarray], top_k: int, answer: str,
+                            context: Dict, usage=None) -> Dict:
+        """Результат ответа; при query_vector из alookup_answer ответ сохраняется в кэш"""
+        # _make_result пишет в семантический кэш (Redis)
+        return await sync_to_async(self._make_result, thread_sensitive=False)(
+            bot, answer, usage, context, top_k, query_vector
+        )
+    
+    @staticmethod
+    def _use_answer_cache(bot, query: str, history: Optional[List[Dict]]) -> bool:
+        # Ответ в диалоге зависит от истории, поэтому кэшируются только самостоятельные вопросы
+        return (
+            bot.answer_cache_enabled
+            and len(query.strip()) >= getattr(settings, 'RAG_ANSWER_CACHE_MIN_QUERY_LENGTH', 10)
+            and len(history or []) <= getattr(settings, 'RAG_ANSWER_CACHE_MAX_HISTORY', 0)
+        )
+    
+    def _pack_context(self, results: List[Dict]) -> Dict:
+        """Контекст из найденных фрагментов: текст, источники, средняя похожесть, токены"""
+        # Размер контекста определяется релевантностью и бюджетом, а не top_k
+        packed, tokens = self.context_packer.pack(results)
+        if results:
+            logger.info(f"Контекст: {len(packed)} из {len(results)} фрагментов, ~{tokens} токенов")
+        
+        if not packed:
+            return {'text': "", 'sources': [], 'confidence': 0.0, 'tokens': tokens}
+        
+        return {
+            'text': "\n\n".join([r['text'] for r in packed]),
+            'sources': list(set([r['source'] for r in packed])),
+            'confidence': sum(r['similarity'] for r in packed) / len(packed),
+            'tokens': tokens,
+        }
+    
+    @staticmethod
+    def _build_messages(bot, query: str, history: Optional[List[Dict]], context: str) -> List[Dict]:
+        # ========== HUMANIZER ==========
+        humanizer = HUMANIZER_INSTRUCTIONS_TEMPLATE.format(
+            bot_name=bot.name,
+            company_name=bot.company_name or "TheCloser"
+        )
+        
+        # ========== USER PROMPT ==========
+        user_prompt = bot.system_prompt or ""
+        
+        # ========== СБОРКА ФИНАЛЬНОГО ПРОМПТА ==========
+        final_system_prompt = humanizer + "\n\n" + user_prompt
+        
+        if context:
+            final_system_prompt += f"""
+
+ВАЖНО: Используй следующую информацию из базы знаний для ответа (если она релевантна):
+
+{context}
+
+Отвечай естественно, как живой человек. Если в базе знаний нет информации, используй свои знания, но отдавай приоритет базе знаний."""
+        
+        # ========== ФОРМИРУЕМ СООБЩЕНИЯ ==========
+        messages = [{"role": "system", "content": final_system_prompt}]
+        
+        if history:
+            for msg in history:
+                role = msg.get('role', 'user')
+                if role not in ['user', 'assistant', 'system']:
+                    role = 'user'
+                messages.append({"role": role, "content": msg.get('content', '')})
+        
+        messages.append({"role": "user", "content": query})
+        return messages
+    
+    @staticmethod
+    def _completion_params(bot, messages: List[Dict]) -> Dict:
+        """Параметры chat.completions.create с учетом типа API модели"""
+        uses_new_api = bot.uses_new_api()
+        
+        logger.info(f"Bot: {bot.name} | Model: {bot.openai_model} | New API: {uses_new_api} | Temp: {bot.temperature} | Max: {bot.max_tokens}")
+        
+        if uses_new_api:
+            logger.info("Using NEW API with max_completion_tokens")
+            return {'model': bot.openai_model, 'messages': messages}
+        
+        logger.info("Using LEGACY API with temperature + max_tokens")
+        return {
+            'model': bot.openai_model,
+            'messages': messages,
+            'temperature': bot.temperature,
+            'max_tokens': bot.max_tokens,
+        }
+    
+    @staticmethod
+    def _make_result(bot, answer: str, usage, context: Dict, top_k: int,
+                     cache_vector: Optional[np.ndarray]) -> Dict:
+        result = {
+            'answer': answer,
+            'sources': context['sources'],
+            'confidence': context['confidence'],
+            'context_tokens': context['tokens']
+        }
+        
+        if cache_vector is not None and answer:
+            tokens = getattr(usage, 'total_tokens', 0) or 0
+            semantic_answer_cache.store(bot, cache_vector, top_k, result, tokens)
+        
+        return result
+    
+    @staticmethod
+    def _error_result() -> Dict:
+        return {
+            'answer': "Извините, произошла ошибка. Попробуйте еще раз.",
+            'sources': [],
+            'confidence': 0.0
+        }
 
 
 # Глобальный экземпляр